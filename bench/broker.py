@@ -0,0 +1,196 @@
+# Minimal in-process MQTT 3.1.1 / 5 broker to run umqtt.py against on a PC.
+#
+# Each socket returned by Broker.socket() is a client connection. Whatever the
+# client writes is parsed right away and the broker's answers are queued for the
+# client to read, so everything runs in a single thread. Supported: CONNECT
+# (with persistent sessions), PUBLISH QoS 0/1 (with MQTT 5 topic aliases),
+# SUBSCRIBE, PINGREQ and DISCONNECT. Every packet received is logged with its
+# size on the wire.
+
+import struct
+
+from hostenv import FakeSocket, remaining_length
+
+
+def _match(filt, topic):
+    f = filt.split(b'/')
+    t = topic.split(b'/')
+    for i, level in enumerate(f):
+        if level == b'#':
+            return True
+        if i >= len(t) or (level != b'+' and level != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+def _varint(data, p):
+    n = 0
+    sh = 0
+    while True:
+        b = data[p]
+        p += 1
+        n |= (b & 0x7F) << sh
+        if not b & 0x80:
+            return n, p
+        sh += 7
+
+
+class BrokerSocket(FakeSocket):
+    def __init__(self, broker, chunk):
+        super().__init__(b'', chunk)
+        self.broker = broker
+        self.inbuf = bytearray()
+        self.version = 4
+        self.client_id = None
+        self.aliases = {}
+        self.closed = False
+
+    def write(self, buf, n=-1):
+        n = super().write(buf, n)
+        self.inbuf += bytes(buf[:n])
+        self.broker._feed(self)
+        return n
+
+    def close(self):
+        self.closed = True
+        self.broker._drop(self)
+
+
+class Broker:
+    def __init__(self, alias_max=0, chunk=1024):
+        self.alias_max = alias_max
+        self.chunk = chunk
+        self.conns = []
+        self.sessions = {}      # client id -> list of (filter, qos), persistent sessions only
+        self.log = []           # (packet type, wire size) of every packet received
+        self.published = []     # (topic, payload, wire size) of every PUBLISH received
+        self.pid = 0
+        self.on_publish = None  # Called with (connection, topic, payload) for every PUBLISH, e.g. to answer requests
+
+    def socket(self):
+        c = BrokerSocket(self, self.chunk)
+        self.conns.append(c)
+        return c
+
+    def _drop(self, c):
+        if c in self.conns:
+            self.conns.remove(c)
+
+    def _feed(self, c):
+        while len(c.inbuf) >= 2:
+            try:
+                sz, p = _varint(c.inbuf, 1)
+            except IndexError:
+                return
+            if len(c.inbuf) < p + sz:
+                return
+            pkt = bytes(c.inbuf[:p + sz])
+            del c.inbuf[:p + sz]
+            self.log.append((pkt[0] & 0xF0, len(pkt)))
+            self._handle(c, pkt[0], pkt[p:])
+
+    def _handle(self, c, op, body):
+        kind = op & 0xF0
+        if kind == 0x10:
+            self._connect(c, body)
+        elif kind == 0x30:
+            self._publish(c, op, body)
+        elif kind == 0x80:
+            self._subscribe(c, body)
+        elif kind == 0xC0:
+            c.feed(b'\xd0\x00')
+        elif kind == 0xE0:
+            c.closed = True
+
+    def _connect(self, c, body):
+        n = struct.unpack('!H', body[:2])[0]
+        p = 2 + n
+        c.version, flags = body[p], body[p + 1]
+        p += 4
+        if c.version == 5:
+            n, p = _varint(body, p)
+            p += n
+        n = struct.unpack('!H', body[p:p + 2])[0]
+        c.client_id = body[p + 2:p + 2 + n]
+        c.subs = []
+        c.aliases = {}
+        present = 0
+        if flags & 2:
+            self.sessions.pop(c.client_id, None)
+        elif c.client_id in self.sessions:
+            c.subs = self.sessions[c.client_id]
+            present = 1
+        else:
+            self.sessions[c.client_id] = c.subs
+        if c.version == 5:
+            props = b''
+            if self.alias_max:
+                props = struct.pack('!BH', 0x22, self.alias_max)
+            var = bytes([present, 0]) + remaining_length(len(props)) + props
+        else:
+            var = bytes([present, 0])
+        c.feed(b'\x20' + remaining_length(len(var)) + var)
+
+    def _publish(self, c, op, body):
+        qos = op >> 1 & 3
+        n = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + n]
+        p = 2 + n
+        pid = 0
+        if qos:
+            pid = struct.unpack('!H', body[p:p + 2])[0]
+            p += 2
+        if c.version == 5:
+            n, p = _varint(body, p)
+            props = body[p:p + n]
+            p += n
+            q = 0
+            while q < len(props):
+                if props[q] == 0x23:
+                    alias = struct.unpack('!H', props[q + 1:q + 3])[0]
+                    assert 0 < alias <= self.alias_max, 'Topic alias out of range'
+                    if topic:
+                        c.aliases[alias] = topic
+                    else:
+                        topic = c.aliases[alias]
+                    q += 3
+                else:
+                    raise ValueError('Unexpected PUBLISH property %d' % props[q])
+        payload = body[p:]
+        self.published.append((topic, payload, len(body) + 1 + len(remaining_length(len(body)))))
+        if qos == 1:
+            c.feed(b'\x40\x02' + struct.pack('!H', pid))
+        for s in list(self.conns):
+            for filt, sqos in getattr(s, 'subs', ()):
+                if _match(filt, topic):
+                    self.deliver(s, topic, payload, min(qos, sqos))
+                    break
+        if self.on_publish:
+            self.on_publish(c, topic, payload)
+
+    def _subscribe(self, c, body):
+        pid = body[:2]
+        p = 2
+        if c.version == 5:
+            n, p = _varint(body, p)
+            p += n
+        codes = bytearray()
+        while p < len(body):
+            n = struct.unpack('!H', body[p:p + 2])[0]
+            filt = body[p + 2:p + 2 + n]
+            qos = body[p + 2 + n] & 3
+            p += 3 + n
+            c.subs.append((filt, qos))
+            codes.append(min(qos, 1))
+        var = pid + (b'\x00' if c.version == 5 else b'') + codes
+        c.feed(b'\x90' + remaining_length(len(var)) + var)
+
+    def deliver(self, c, topic, payload, qos=0):
+        """ Send a PUBLISH to client connection c """
+        var = struct.pack('!H', len(topic)) + topic
+        if qos:
+            self.pid = self.pid % 65535 + 1
+            var += struct.pack('!H', self.pid)
+        if c.version == 5:
+            var += b'\x00'
+        c.feed(bytes([0x30 | qos << 1]) + remaining_length(len(var) + len(payload)) + var + payload)
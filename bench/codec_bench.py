@@ -0,0 +1,131 @@
+# Compare the payload_codec encoders on recorded d2c traffic.
+#
+# Encodes every message of the recording (one JSON document per line,
+# bench/data/tracker_d2c.jsonl by default) with json.dumps() as sent today,
+# compact JSON, compact JSON with fixed-point floats, and CBOR, and reports the
+# bytes per message and per appId. Every encoding is decoded again and checked
+# against the original (floats within the configured precision).
+#
+# Each codec is also run the way nRFCloudMQTT.encode() sends it with a
+# DeflateCodec compressor (bytes_per_msg_deflate), and that payload is decoded
+# again the same way: JSON is compressed, CBOR must be left alone.
+#
+#   $ python3 bench/codec_bench.py
+
+import argparse
+import json
+import math
+import os
+import struct
+
+import hostenv
+
+hostenv.install()
+
+import nrfcloud_mqtt  # noqa: E402
+from payload_codec import CBORCodec, DeflateCodec, JSONCodec, TRACKER_PRECISION  # noqa: E402
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tracker_d2c.jsonl')
+
+
+class Nic:
+    def status(self, key):
+        return ''
+
+
+def cbor_decode(data, p=0):
+    """ Minimal CBOR decoder for what CBORCodec produces. Returns (value, next offset). """
+    ib = data[p]
+    major, info = ib >> 5, ib & 0x1F
+    p += 1
+    if major == 7:
+        if info == 26:
+            return struct.unpack('>f', data[p:p + 4])[0], p + 4
+        if info == 27:
+            return struct.unpack('>d', data[p:p + 8])[0], p + 8
+        return {20: False, 21: True, 22: None}[info], p
+    if info < 24:
+        n = info
+    else:
+        k = 1 << (info - 24)
+        n = int.from_bytes(data[p:p + k], 'big')
+        p += k
+    if major == 0:
+        return n, p
+    if major == 1:
+        return -1 - n, p
+    if major in (2, 3):
+        v = data[p:p + n]
+        return (v.decode() if major == 3 else v), p + n
+    if major == 4:
+        out = []
+        for _ in range(n):
+            v, p = cbor_decode(data, p)
+            out.append(v)
+        return out, p
+    if major == 5:
+        out = {}
+        for _ in range(n):
+            k, p = cbor_decode(data, p)
+            out[k], p = cbor_decode(data, p)
+        return out, p
+    if major == 6 and n == 4:     # Decimal fraction
+        (e, m), p = cbor_decode(data, p)
+        return m * 10.0 ** e, p
+    raise ValueError('Unsupported CBOR item 0x%02x' % ib)
+
+
+def same(a, b, key=None, precision=TRACKER_PRECISION):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(same(a[k], b[k], k) for k in a)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(same(x, y, key) for x, y in zip(a, b))
+    if isinstance(a, float):
+        d = precision.get(key)
+        return math.isclose(a, b, rel_tol=1e-6) if d is None else abs(a - b) <= 0.5 * 10 ** -d + 1e-9
+    return a == b
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('input', nargs='?', default=DEFAULT_INPUT, help='Recorded payloads, one per line')
+    args = ap.parse_args()
+    with open(args.input) as f:
+        msgs = [json.loads(line) for line in f if line.strip()]
+    codecs = {
+        'json': (JSONCodec(compact=False), json.loads),
+        'json_compact': (JSONCodec(), json.loads),
+        'json_fixed': (JSONCodec(TRACKER_PRECISION), json.loads),
+        'cbor': (CBORCodec(TRACKER_PRECISION), lambda b: cbor_decode(b)[0]),
+    }
+    compressor = DeflateCodec()
+    cloud = nrfcloud_mqtt.nRFCloudMQTT(Nic(), 'nrf-bench', compressor=compressor)
+    results = {}
+    for name, (codec, decode) in codecs.items():
+        cloud.default_codec = codec
+        per_app = {}
+        total = 0
+        total_deflate = 0
+        for m in msgs:
+            e = codec.encode(m)
+            assert same(m, decode(e)), f'{name}: {m} != {decode(e)}'
+            total += len(e)
+            c = cloud.encode(m)
+            if isinstance(codec, CBORCodec):
+                assert c == e, f'{name}: compressed'
+            d = decode(compressor.decode(c))
+            assert same(m, d), f'{name} + deflate: {m} != {d}'
+            total_deflate += len(c)
+            a = per_app.setdefault(m['appId'], [0, 0])
+            a[0] += 1
+            a[1] += len(e)
+        results[name] = {
+            'bytes_per_msg': round(total / len(msgs), 1),
+            'bytes_per_msg_deflate': round(total_deflate / len(msgs), 1),
+            'per_app': {k: round(v[1] / v[0], 1) for k, v in per_app.items()},
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Measure payload_codec.DeflateCodec on recorded d2c traffic.
+#
+# The input has one JSON payload per line, as sent by nRFCloudMQTT.d2c()
+# (bench/data/tracker_d2c.jsonl holds a day of asset tracker messages). Each
+# payload is encoded on its own and, to show what batching uplinks gains, in
+# groups of --group messages sent as one JSON array. Reports the compression
+# ratio and the encode time with and without the substitution table, and checks
+# that every payload decodes back to the original.
+#
+#   $ python3 bench/compress_bench.py
+#   $ python3 bench/compress_bench.py --threshold 64 --group 8
+#   $ python3 bench/compress_bench.py --train     # Suggest table entries
+#   $ python3 bench/compress_bench.py --compact   # As compact JSON, like the tracker sends
+#
+# The recording is json.dumps() output; --compact encodes it again with
+# payload_codec.JSONCodec() first, which uses the compact variant of the table.
+#
+# The deflate window on the host is 512 bytes (zlib's minimum), the device
+# uses 256 by default, so ratios on the device are slightly lower.
+
+import argparse
+import json
+import os
+import re
+import time
+from collections import Counter
+
+import hostenv
+
+hostenv.install()
+
+from payload_codec import DeflateCodec, JSONCodec, NRFCLOUD_TABLE  # noqa: E402
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tracker_d2c.jsonl')
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return [line.rstrip(b'\n') for line in f if line.strip()]
+
+
+def measure(codec, payloads):
+    raw = out = encoded = 0
+    t = time.perf_counter()
+    res = [codec.encode(p) for p in payloads]
+    t = time.perf_counter() - t
+    for p, e in zip(payloads, res):
+        assert codec.decode(e) == p, 'Round trip failed'
+        raw += len(p)
+        out += len(e)
+        encoded += e is not p
+    return {
+        'payloads': len(payloads),
+        'encoded': encoded,
+        'bytes_in': raw,
+        'bytes_out': out,
+        'ratio': round(out / raw, 3),
+        'encode_us': round(t / len(payloads) * 1e6, 1),
+    }
+
+
+def train(payloads, n):
+    # Keys with their separator, and string values, weighted by the bytes they would save
+    tokens = Counter()
+    for p in payloads:
+        for m in re.finditer(rb'"[^"]+": ?|"[^"]+"', p):
+            tokens[m.group()] += 1
+    best = sorted((kv for kv in tokens.items() if kv[1] > 1),
+                  key=lambda kv: (len(kv[0]) - 1) * kv[1], reverse=True)[:n]
+    for tok, count in sorted(best, key=lambda kv: -len(kv[0])):
+        print(f'    {tok!r},    # {count} times')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('input', nargs='?', default=DEFAULT_INPUT, help='Recorded payloads, one per line')
+    ap.add_argument('--threshold', type=int, default=96)
+    ap.add_argument('--group', type=int, default=4, help='Messages per batched uplink')
+    ap.add_argument('--train', action='store_true', help='Print the most profitable table entries')
+    ap.add_argument('--compact', action='store_true', help='Encode the payloads as compact JSON first')
+    args = ap.parse_args()
+    payloads = load(args.input)
+    if args.compact:
+        codec = JSONCodec()
+        payloads = [codec.encode(json.loads(p)) for p in payloads]
+    if args.train:
+        train(payloads, 31)
+        return
+    sep = b',' if args.compact else b', '
+    groups = [b'[' + sep.join(payloads[i:i + args.group]) + b']' for i in range(0, len(payloads), args.group)]
+    results = {}
+    for name, table in (('deflate', ()), ('table+deflate', NRFCLOUD_TABLE)):
+        for kind, data in (('single', payloads), ('group%d' % args.group, groups)):
+            results[f'{name} {kind}'] = measure(DeflateCodec(args.threshold, table), data)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
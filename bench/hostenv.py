@@ -0,0 +1,186 @@
+# Host-side environment to run the helper scripts under CPython.
+#
+# Installs the MicroPython-only modules that the helper scripts need (ustruct,
+# ubinascii, uselect, micropython.const, the const() builtin, time.sleep_ms,
+# time.ticks_*)
+# and provides a fake socket that counts the calls made into it, standing in for
+# the modem's offloaded socket. SocketModule
+# replaces the socket module seen by umqtt so that its sockets connect to an
+# in-process broker (see broker.py).
+
+import builtins
+import os
+import struct
+import binascii
+import sys
+import time
+import types
+
+_TICKS_MAX = (1 << 30) - 1   # MicroPython ticks wrap at 2**30
+
+
+def _ticks_diff(a, b):
+    return ((a - b + (1 << 29)) & _TICKS_MAX) - (1 << 29)
+
+
+HELPER_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper_scripts')
+
+
+def install():
+    sys.modules.setdefault('ustruct', struct)
+    sys.modules.setdefault('ubinascii', binascii)
+    if 'uselect' not in sys.modules:
+        sel = types.ModuleType('uselect')
+        sel.POLLIN, sel.POLLOUT, sel.POLLERR, sel.POLLHUP = 1, 4, 8, 16
+        sel.poll = Poll
+        sys.modules['uselect'] = sel
+    if 'micropython' not in sys.modules:
+        mp = types.ModuleType('micropython')
+        mp.const = lambda x: x
+        sys.modules['micropython'] = mp
+    # MicroPython code may use const() without importing it (nrfcloud_mqtt.py does)
+    if not hasattr(builtins, 'const'):
+        builtins.const = lambda x: x
+    if not hasattr(time, 'sleep_ms'):
+        time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    if not hasattr(time, 'ticks_ms'):
+        time.ticks_ms = lambda: int(time.monotonic() * 1000) & _TICKS_MAX
+        time.ticks_add = lambda t, d: (t + d) & _TICKS_MAX
+        time.ticks_diff = _ticks_diff
+    if HELPER_SCRIPTS not in sys.path:
+        sys.path.insert(0, HELPER_SCRIPTS)
+
+
+class FakeSocket:
+    """ Socket with scripted incoming data. Each read returns at most `chunk` bytes,
+    like the modem handing over data one TLS record at a time. """
+
+    def __init__(self, incoming=b'', chunk=1024):
+        self.rx = bytearray(incoming)
+        self.tx = bytearray()
+        self.chunk = chunk
+        self.blocking = True
+        self.reads = 0
+        self.writes = 0
+
+    def feed(self, data):
+        self.rx += data
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def _take(self, n):
+        if not self.rx:
+            if not self.blocking:
+                return None
+            return b''
+        n = min(n, self.chunk, len(self.rx))
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        self.reads += 1
+        return data
+
+    def read(self, n):
+        return self._take(n)
+
+    def readinto(self, buf, n=-1):
+        data = self._take(len(buf) if n < 0 else n)
+        if data is None:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+        self.tx += bytes(buf[:n])
+        self.writes += 1
+        return n
+
+    def tlswrap(self, sec_tag, verify=2, hostname=None):
+        pass
+
+    def connect(self, addr):
+        pass
+
+    def close(self):
+        pass
+
+
+class Poll:
+    """ select.poll() over FakeSockets. Nothing arrives while the client waits
+    (the broker answers as soon as a packet is written), so poll() returns at
+    once when no socket is readable, after sleeping for the timeout """
+
+    def __init__(self):
+        self.socks = {}
+
+    def register(self, sock, mask=1):
+        self.socks[sock] = mask
+
+    def modify(self, sock, mask):
+        self.socks[sock] = mask
+
+    def unregister(self, sock):
+        self.socks.pop(sock, None)
+
+    def poll(self, timeout=-1):
+        ready = [(s, 1) for s, mask in self.socks.items() if mask & 1 and (s.rx or getattr(s, 'closed', False))]
+        if not ready:
+            if timeout < 0:
+                raise OSError('poll() without a timeout would block forever')
+            time.sleep(timeout / 1000)
+        return ready
+
+
+class SinkSocket(FakeSocket):
+    """ FakeSocket that counts what is written without keeping it, so that
+    measuring the client's allocations doesn't include the socket's own """
+
+    def write(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+        self.n_tx += n
+        self.writes += 1
+        return n
+
+    n_tx = 0
+
+
+class SocketModule:
+    """ Stand-in for the socket module used by umqtt.py: umqtt.socket = SocketModule(broker) """
+    AF_INET = 2
+    SOCK_STREAM = 1
+    IPPROTO_TLS_1_2 = 258
+    TLS_PEER_VERIFY_NONE = 0
+    TLS_PEER_VERIFY_OPTIONAL = 1
+    TLS_PEER_VERIFY_REQUIRED = 2
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.lookups = 0
+
+    def getaddrinfo(self, host, port):
+        self.lookups += 1
+        return [(self.AF_INET, self.SOCK_STREAM, 0, '', ('127.0.0.1', port))]
+
+    def socket(self, *args):
+        return self.broker.socket()
+
+
+def mqtt_publish_packet(topic, msg, qos=0, pid=1):
+    """ Encode a PUBLISH packet as sent by a broker """
+    var = struct.pack('!H', len(topic)) + topic
+    if qos:
+        var += struct.pack('!H', pid)
+    return bytes([0x30 | qos << 1]) + remaining_length(len(var) + len(msg)) + var + msg
+
+
+def remaining_length(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
@@ -0,0 +1,64 @@
+# Check MQTT 5 topic aliases against the in-process broker and compare the
+# bytes on the wire with MQTT 3.1.1.
+#
+# Publishes the same messages on a few topics with version=4 and version=5 and
+# reports the size of the PUBLISH packets the broker received.
+#
+#   $ python3 bench/mqtt5_alias_check.py --messages 50 --size 32
+
+import argparse
+
+import hostenv
+
+hostenv.install()
+
+import umqtt  # noqa: E402
+from broker import Broker  # noqa: E402
+
+TOPICS = [b'prod/a1b2c3d4-0000-1111-2222-333344445555/m/d/nrf-351358811111111/d2c',
+          b'prod/a1b2c3d4-0000-1111-2222-333344445555/m/d/nrf-351358811111111/d2c/bulk',
+          b'$aws/things/nrf-351358811111111/shadow/update']
+
+
+def run(version, messages, size, alias_max, qos):
+    broker = Broker(alias_max=alias_max)
+    umqtt.socket = hostenv.SocketModule(broker)
+    c = umqtt.MQTTClient('nrf-351358811111111', 'broker', version=version)
+    c.connect()
+    handles = [c.topic(t) for t in TOPICS]
+    sent = []
+    for i in range(messages):
+        t = handles[i % len(handles)]
+        msg = bytes([i & 0xFF]) * size
+        c.publish(t, msg, qos=qos)
+        sent.append((t.name, msg))
+    c.disconnect()
+    got = [(t, m) for t, m, _ in broker.published]
+    assert got == sent, 'Broker resolved different topics or payloads'
+    return {
+        'version': version,
+        'alias_max': c.alias_max,
+        'publish_bytes': sum(n for _, _, n in broker.published),
+        'alias_saved': c.alias_saved,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--messages', type=int, default=50)
+    ap.add_argument('--size', type=int, default=32)
+    ap.add_argument('--alias-max', type=int, default=8, help='Topic Alias Maximum sent by the broker')
+    ap.add_argument('--qos', type=int, default=1)
+    args = ap.parse_args()
+    v4 = run(4, args.messages, args.size, args.alias_max, args.qos)
+    v5 = run(5, args.messages, args.size, args.alias_max, args.qos)
+    v5_none = run(5, args.messages, args.size, 0, args.qos)
+    assert v5['alias_saved'] > 0 or not args.alias_max
+    assert v5_none['alias_saved'] == 0
+    for r in (v4, v5_none, v5):
+        print(f"MQTT {r['version']} (alias max {r['alias_max']}): {r['publish_bytes']} PUBLISH bytes, "
+              f"{r['alias_saved']} saved by aliases")
+
+
+if __name__ == '__main__':
+    main()
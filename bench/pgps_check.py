@@ -0,0 +1,90 @@
+# Check nrfcloud_mqtt.PGPSStore against P-GPS files laid out like the nRF
+# Connect SDK schema v1 (nrf_cloud_pgps_schema_v1.h).
+#
+# Builds a file of --count predictions field by field from the schema: a
+# header (schema version, type 22, 1 item, count, period, GPS day and time of
+# day), then per prediction a schema version byte, a system time element
+# (type 7, 1 item: date_day u16, time_full_s u32, time_frac_ms u16, sv_mask
+# u32, pad u32), an ephemeris element (type 2, 32 items of 62 bytes) and the
+# sentinel 0xDEADBEEF. The predictions start one period ago, so lookup() must
+# return the ephemerides of the second one. Files that break the schema (no
+# schema byte per prediction, a wrong sentinel, a short download) must be
+# rejected and leave the stored predictions alone.
+#
+#   $ python3 bench/pgps_check.py
+#   $ python3 bench/pgps_check.py --count 42
+
+import argparse
+import io
+import json
+import os
+import struct
+import tempfile
+
+import hostenv
+
+hostenv.install()
+
+import nrfcloud_mqtt  # noqa: E402
+
+PERIOD = 240
+NUM_SV = 32
+EPH_SIZE = 62
+
+
+def ephemerides(i):
+    # 32 ephemerides whose bytes tell the prediction and satellite apart
+    return b''.join(bytes([i & 0xFF, sv]) * (EPH_SIZE // 2) for sv in range(1, NUM_SV + 1))
+
+
+def prediction(i, start, schema=True, sentinel=0xDEADBEEF):
+    t = start + i * PERIOD * 60
+    p = struct.pack('<B', 1) if schema else b''
+    p += struct.pack('<BH', 7, 1)
+    p += struct.pack('<HIHII', t // 86400, t % 86400, 0, 0xFFFFFFFF, 0)
+    p += struct.pack('<BH', 2, NUM_SV) + ephemerides(i)
+    return p + struct.pack('<I', sentinel)
+
+
+def pgps_file(count, start, **kw):
+    hdr = struct.pack('<bBHHHHI', 1, 22, 1, count, PERIOD, start // 86400, start % 86400)
+    return hdr + b''.join(prediction(i, start, **kw) for i in range(count))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--count', type=int, default=6, help='Predictions in the file')
+    args = ap.parse_args()
+    start = nrfcloud_mqtt._gps_time() - PERIOD * 60 - 60
+    with tempfile.TemporaryDirectory() as d:
+        store = nrfcloud_mqtt.PGPSStore(os.path.join(d, 'pgps'), count=args.count, period=PERIOD)
+        data = pgps_file(args.count, start)
+        store._store(io.BytesIO(data))
+        blob = store.lookup()
+        assert blob == b'\x01' + struct.pack('<BH', 2, NUM_SV) + ephemerides(1), 'Wrong prediction injected'
+        assert store.remaining() == args.count - 1
+        assert store.bytes_downloaded == len(data)
+        size = os.path.getsize(store.path)
+        rejected = {}
+        for name, bad in (('no_schema_byte', pgps_file(args.count, start, schema=False)),
+                          ('bad_sentinel', pgps_file(args.count, start, sentinel=0)),
+                          ('truncated', data[:-100])):
+            try:
+                store._store(io.BytesIO(bad))
+                rejected[name] = False
+            except (OSError, ValueError):
+                rejected[name] = True
+            assert store.lookup() == blob, f'{name}: stored predictions changed'
+        assert all(rejected.values()), rejected
+        print(json.dumps({
+            'predictions': args.count,
+            'download_bytes': len(data),
+            'prediction_bytes': len(prediction(0, start)),
+            'file_bytes': size,
+            'remaining': store.remaining(),
+            'rejected': rejected,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
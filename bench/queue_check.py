@@ -0,0 +1,82 @@
+# Check that mqtt_queue.MQTTQueue picks up where it left off after a reboot.
+#
+# Fills a small queue until it starts evicting, drains part of it, and loads
+# it again from the segment files, as after a reboot. The reloaded queue must
+# have the same messages waiting, and the next put() must go into the current
+# segment when it has room, without evicting anything. The same is checked
+# right after a segment has been reused (it starts with a drain mark), and
+# the messages drained after the reload must be the ones that were waiting.
+#
+#   $ python3 bench/queue_check.py
+#   $ python3 bench/queue_check.py --size 4096 --segments 8
+
+import argparse
+import json
+import os
+import tempfile
+
+import hostenv
+
+hostenv.install()
+
+from mqtt_queue import MQTTQueue  # noqa: E402
+
+TOPIC = b'd2c'
+
+
+def reload(q):
+    return MQTTQueue(q.path, q.seg_size * q.segments, q.segments)
+
+
+def check_put(q, name):
+    # One small message fits in the current segment unless it is nearly full
+    fits = q._seg_len(q._cur) + 9 + len(TOPIC) + 1 <= q.seg_size
+    pending = q.pending()
+    q.put(TOPIC, b'y')
+    if fits:
+        assert q.dropped == 0, f'{name}: put() evicted {q.dropped} messages'
+        assert q.pending() == pending + 1, f'{name}: {pending} -> {q.pending()} waiting'
+    return fits
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--size', type=int, default=1024, help='Queue size in bytes')
+    ap.add_argument('--segments', type=int, default=4)
+    ap.add_argument('--drain', type=int, default=1, help='Messages drained before the reload')
+    args = ap.parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as d:
+        q = MQTTQueue(os.path.join(d, 'q'), args.size, args.segments)
+        i = 0
+        while not q.dropped:
+            q.put(TOPIC, b'%04d' % i + b'x' * 16)
+            i += 1
+        results['filled'] = q.pending()
+        q.drain(lambda *a: None, args.drain)
+        waiting = q.pending()
+        q = reload(q)
+        assert q.pending() == waiting, f'{waiting} waiting before the reload, {q.pending()} after'
+        results['after_drain'] = {'pending': waiting, 'put_in_segment': check_put(q, 'after drain')}
+
+        # Until a segment is reused: the reloaded current segment starts with a mark
+        cur = q._cur
+        while q._cur == cur:
+            q.put(TOPIC, b'z' * 16)
+        q.dropped = 0
+        waiting = q.pending()
+        q = reload(q)
+        assert q.pending() == waiting, f'{waiting} waiting before the reload, {q.pending()} after'
+        results['reused_segment'] = {'pending': waiting, 'put_in_segment': check_put(q, 'reused segment')}
+
+        sent = []
+        while q.drain(lambda t, m, r, qos: sent.append(m)):
+            pass
+        assert len(sent) == waiting + 1, f'{len(sent)} drained, {waiting + 1} waiting'
+        assert q.pending() == 0
+        results['drained_after_reload'] = len(sent)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Count socket read calls per received MQTT message.
+#
+# Runs helper_scripts/umqtt.py under CPython with a fake socket that already
+# holds a stream of PUBLISH, PUBACK and PINGRESP packets, and reports how many
+# times the client had to call into the socket to receive them.
+#
+#   $ python3 bench/recv_bench.py --messages 200 --size 64 --chunk 1024
+
+import argparse
+
+import hostenv
+
+hostenv.install()
+
+from umqtt import MQTTClient  # noqa: E402
+
+
+def run(messages, size, chunk, qos):
+    stream = bytearray()
+    for i in range(messages):
+        stream += hostenv.mqtt_publish_packet(b'prod/team/m/d/nrf-123/c2d', bytes(size), qos, i + 1)
+        stream += b'\x40\x02' + (i + 1).to_bytes(2, 'big')  # PUBACK
+        stream += b'\xd0\x00'  # PINGRESP
+    sock = hostenv.FakeSocket(stream, chunk)
+    received = []
+    c = MQTTClient('bench', 'localhost')
+    c.sock = sock
+    c.set_callback(lambda topic, msg: received.append(len(msg)))
+    while sock.rx or c._rs < c._re:
+        c.wait_msg()
+    assert len(received) == messages
+    return {
+        'messages': messages,
+        'payload': size,
+        'chunk': chunk,
+        'qos': qos,
+        'reads': sock.reads,
+        'reads_per_msg': sock.reads / messages,
+        'writes': sock.writes,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--messages', type=int, default=200)
+    ap.add_argument('--size', type=int, default=64)
+    ap.add_argument('--chunk', type=int, default=1024, help='Max bytes returned by one socket read')
+    ap.add_argument('--qos', type=int, default=0)
+    args = ap.parse_args()
+    r = run(args.messages, args.size, args.chunk, args.qos)
+    print(f"{r['messages']} messages of {r['payload']} bytes, QoS {r['qos']}: "
+          f"{r['reads']} reads ({r['reads_per_msg']:.2f} per message), {r['writes']} writes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Time from connect() to the first d2c message with nRFCloudMQTT, with and
+# without the topic prefix cached on flash (prefix_path).
+#
+# The broker stand-in answers shadow gets like nRF Cloud does. Without a cached
+# prefix connect() waits for the shadow before subscribing; with one it goes
+# straight to subscribing and the shadow is checked from process() afterwards.
+# Reports the time to the first d2c PUBLISH and the packets sent before it,
+# also when the broker still has a persistent session (clean_session False),
+# and the SUBSCRIBEs sent including the background check (none in that case).
+# Each packet the client waits for costs a network round trip on the device
+# (hundreds of ms on LTE-M/NB-IoT), which the host doesn't show; --rtt adds
+# that delay to every packet the broker sends back.
+#
+#   $ python3 bench/startup_bench.py
+#   $ python3 bench/startup_bench.py --rtt 300
+#   $ python3 bench/startup_bench.py --stale    # The cached prefix is out of date
+#
+# With --stale the first d2c goes to the old topic (d2c_topic_ok is false), and
+# the prefix and cache are corrected by process().
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import hostenv
+
+hostenv.install()
+
+import nrfcloud_mqtt  # noqa: E402
+import umqtt  # noqa: E402
+from broker import Broker, BrokerSocket  # noqa: E402
+
+DEVICE_ID = 'nrf-351358811111111'
+PREFIX = 'prod/a1b2c3d4-0000-1111-2222-333344445555/'
+
+
+class Nic:
+    def status(self, key):
+        return ''
+
+
+class SlowSocket(BrokerSocket):
+    # Packets from the broker become readable rtt ms after the client's packet that caused them
+    rtt = 0
+
+    def feed(self, data):
+        if self.rtt:
+            time.sleep(self.rtt / 1000)
+        super().feed(data)
+
+
+class ShadowBroker(Broker):
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+        self.on_publish = self._answer
+
+    def socket(self):
+        c = SlowSocket(self, self.chunk)
+        self.conns.append(c)
+        return c
+
+    def _answer(self, c, topic, payload):
+        if topic == b'$aws/things/%s/shadow/get' % DEVICE_ID.encode():
+            shadow = {'desired': {'pairing': {'state': 'paired'}, 'nrfcloud_mqtt_topic_prefix': self.prefix}}
+            self.deliver(c, b'%s/shadow/get/accepted' % DEVICE_ID.encode(), json.dumps(shadow).encode())
+
+
+def boot(broker, prefix_path, clean_session=True):
+    umqtt.socket = hostenv.SocketModule(broker)
+    cloud = nrfcloud_mqtt.nRFCloudMQTT(Nic(), DEVICE_ID, prefix_path=prefix_path)
+    cloud.clean_session = clean_session
+    broker.log.clear()
+    broker.published.clear()
+    t = time.perf_counter()
+    assert cloud.connect() == 0
+    cloud.d2c({'appId': 'TEMP', 'messageType': 'DATA', 'data': 21.5})
+    t = time.perf_counter() - t
+    d2c = [topic for topic, _, _ in broker.published if topic.endswith(b'/d2c')]
+    res = {
+        'ms_to_first_d2c': round(t * 1000, 1),
+        'packets_before_d2c': len(broker.log) - 1,
+        'd2c_topic_ok': d2c[0] == (PREFIX + 'm/d/%s/d2c' % DEVICE_ID).encode(),
+    }
+    # Let the background check of the cached prefix run
+    cloud.process()
+    cloud.process()
+    res['prefix_after_process'] = cloud.prefix
+    res['subscribes'] = sum(1 for t, _ in broker.log if t == 0x80)
+    cloud.disconnect()
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--rtt', type=int, default=0, help='Network round trip in ms')
+    ap.add_argument('--stale', action='store_true', help='Start from a cached prefix that is no longer valid')
+    args = ap.parse_args()
+    SlowSocket.rtt = args.rtt
+    broker = ShadowBroker(PREFIX)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'nrfcloud_prefix.json')
+        results = {'cold': boot(broker, path)}
+        if args.stale:
+            with open(path, 'w') as f:
+                json.dump({DEVICE_ID: 'prod/old-team/'}, f)
+            results['stale'] = boot(broker, path)
+        results['warm'] = boot(broker, path)
+        assert results['warm']['d2c_topic_ok']
+        # The first connection with a persistent session subscribes, the next finds the session present
+        boot(broker, path, False)
+        results['warm_session_present'] = boot(broker, path, False)
+        assert results['warm_session_present']['d2c_topic_ok']
+        assert results['warm_session_present']['subscribes'] == 0
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# umqtt benchmark suite.
+#
+# Runs helper_scripts/umqtt.py under CPython against the in-process broker
+# (broker.py) and measures, for QoS 0 and QoS 1 (blocking, with an in-flight
+# window, and in batches):
+#   - publish and receive throughput (messages/s on this PC, only useful to
+#     compare runs on the same machine)
+#   - socket writes and reads per message, the calls that go into the modem
+#   - bytes allocated per publish (tracemalloc, against a sink socket so only
+#     the client's allocations are counted)
+#
+# Results are printed as JSON. --compare shows the change against an earlier
+# result file:
+#
+#   $ python3 bench/umqtt_bench.py --out base.json
+#   $ python3 bench/umqtt_bench.py --compare base.json
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import hostenv
+
+hostenv.install()
+
+import umqtt  # noqa: E402
+from broker import Broker  # noqa: E402
+
+TOPIC = b'prod/a1b2c3d4-0000-1111-2222-333344445555/m/d/nrf-351358811111111/d2c'
+
+# Name, qos, max_inflight, messages per batch() (0: no batching)
+PUBLISH_CASES = [('qos0', 0, 0, 0), ('qos1', 1, 0, 0), ('qos1_window4', 1, 4, 0),
+                 ('qos1_window4_batch3', 1, 4, 3)]
+
+
+def bench_publish(qos, inflight, batch, messages, size, registered):
+    broker = Broker()
+    umqtt.socket = hostenv.SocketModule(broker)
+    c = umqtt.MQTTClient('bench', 'broker', max_inflight=inflight)
+    c.connect()
+    sock = c.sock
+    topic = c.topic(TOPIC) if registered else TOPIC
+    msg = bytes(size)
+    w = sock.writes
+    r = sock.reads
+    t = time.perf_counter()
+    if batch:
+        for _ in range(messages // batch):
+            with c.batch():
+                for _ in range(batch):
+                    c.publish(topic, msg, qos=qos)
+        messages = messages // batch * batch
+    else:
+        for _ in range(messages):
+            c.publish(topic, msg, qos=qos)
+    c.wait_acks()
+    t = time.perf_counter() - t
+    assert len(broker.published) == messages
+    return {
+        'msgs_per_s': round(messages / t),
+        'writes_per_msg': (sock.writes - w) / messages,
+        'reads_per_msg': (sock.reads - r) / messages,
+        'tx_bytes_per_msg': sum(n for _, _, n in broker.published) / messages,
+    }
+
+
+def bench_alloc(qos, inflight, messages, size, registered):
+    # PUBACKs for every message are waiting in the socket from the start
+    acks = b''.join(b'\x40\x02' + (i + 1).to_bytes(2, 'big') for i in range(messages))
+    sock = hostenv.SinkSocket(acks)
+    c = umqtt.MQTTClient('bench', 'broker', max_inflight=inflight)
+    c.sock = sock
+    topic = c.topic(TOPIC) if registered else TOPIC
+    msg = bytes(size)
+    c.publish(topic, msg, qos=qos)      # Warm up
+    c.wait_acks()
+    tracemalloc.start()
+    peak = 0
+    for _ in range(messages - 1):
+        cur = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        c.publish(topic, msg, qos=qos)
+        peak += tracemalloc.get_traced_memory()[1] - cur
+    c.wait_acks()
+    tracemalloc.stop()
+    return {'alloc_bytes_per_publish': round(peak / (messages - 1), 1)}
+
+
+def bench_receive(qos, messages, size, chunk):
+    stream = bytearray()
+    for i in range(messages):
+        stream += hostenv.mqtt_publish_packet(TOPIC, bytes(size), qos, i + 1)
+    sock = hostenv.FakeSocket(stream, chunk)
+    c = umqtt.MQTTClient('bench', 'broker')
+    c.sock = sock
+    got = []
+    c.set_callback(lambda topic, msg: got.append(len(msg)))
+    t = time.perf_counter()
+    while sock.rx or c._rs < c._re:
+        c.wait_msg()
+    t = time.perf_counter() - t
+    assert len(got) == messages
+    return {
+        'msgs_per_s': round(messages / t),
+        'reads_per_msg': sock.reads / messages,
+        'writes_per_msg': sock.writes / messages,
+    }
+
+
+def run(messages, size, chunk, registered):
+    results = {}
+    for name, qos, inflight, batch in PUBLISH_CASES:
+        r = bench_publish(qos, inflight, batch, messages, size, registered)
+        if not batch:
+            r.update(bench_alloc(qos, inflight, min(messages, 200), size, registered))
+        results['publish_' + name] = r
+    for qos in (0, 1):
+        results['receive_qos%d' % qos] = bench_receive(qos, messages, size, chunk)
+    return {
+        'params': {'messages': messages, 'size': size, 'chunk': chunk, 'registered_topic': registered},
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+
+
+def compare(new, old):
+    for case, r in new['results'].items():
+        base = old['results'].get(case, {})
+        for metric, v in r.items():
+            b = base.get(metric)
+            if b is None:
+                continue
+            change = (v - b) / b * 100 if b else 0.0
+            print(f'{case:24} {metric:24} {b:>12} -> {v:<12} {change:+.1f}%')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--messages', type=int, default=2000)
+    ap.add_argument('--size', type=int, default=64)
+    ap.add_argument('--chunk', type=int, default=1024, help='Max bytes returned by one socket read')
+    ap.add_argument('--plain-topic', action='store_true', help='Publish with a str/bytes topic instead of a registered Topic')
+    ap.add_argument('--out', help='Write the JSON results to this file')
+    ap.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = ap.parse_args()
+    res = run(args.messages, args.size, args.chunk, not args.plain_topic)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(res, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(res, json.load(f))
+    elif not args.out:
+        print(json.dumps(res, indent=2))
+
+
+if __name__ == '__main__':
+    main()
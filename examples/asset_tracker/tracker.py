@@ -1,6 +1,9 @@
 import network
 import time
-from nrfcloud_mqtt import nRFCloudMQTT
+from nrfcloud_mqtt import nRFCloudMQTT, GroundFixCache, AGNSSCache, PGPSStore
+from mqtt_queue import MQTTQueue
+from mqtt_reconnect import AddrCache, Supervisor
+from payload_codec import JSONCodec, TRACKER_PRECISION
 from micropython import const
 from collections import deque
 from machine import Pin
@@ -27,20 +30,28 @@ _IRQ_CELL_LOCATION_REQUEST      = const(0x1000)
 nic = network.CELL()    # This is a singleton, so we should only get it once
 
 publish_msg = deque((), 5)      # For messaging from the IRQ handler, since we shouldn't be doing time consuming things like publishing in the handler
+cloud = None                    # nRFCloudMQTT, once created. The IRQ handler passes it the radio state for the keepalive scheduling
+link = None                     # Reconnection supervisor, told about network registration by the IRQ handler
 
 def irq_handler(event, data):
     if event == _IRQ_NW_REG_STATUS:
         # Data is the registration status, same as response to AT+CEREG?
         print(f'Registration status: {str(data)}')
+        if link:
+            link.nw_update(data)
     elif event == _IRQ_RRC_UPDATE:
         # Data is True if connected, False if idle
         print(f'RRC Mode: {"Connected" if data else "Idle"}')
+        if cloud:
+            cloud.rrc_update(data)
     elif event == _IRQ_CELL_UPDATE:
         publish_msg.append((_IRQ_CELL_UPDATE, data))
     elif event == _IRQ_PSM_UPDATE:
         print(f'PSM parameter update: TAU {data[0]}, Active time {data[1]}')
     elif event == _IRQ_EDRX_UPDATE:
         print(f'eDRX parameter update: Cycle {data[0]}s, PTW {data[1]}s')
+        if cloud:
+            cloud.set_edrx(data[0])
     elif event == _IRQ_LOCATION_FOUND:
         dt_index = 0        # Index in the data tuple where to find datetime. If there is no datetime, then stays at 0
         gnss_index = 0      # Index in the data tuple where to find additional GNSS data. If 0, there is no data
@@ -82,6 +93,7 @@ def button_publish(p, cloud):
         cloud.d2c({"appId":"BUTTON","messageType":"DATA","data": board.button1.value()})
 
 def run():
+    global cloud, link
     # console_disable(seconds) takes in the number of seconds to disable for. If 0, then it disables
     # indefinitely until console_enable() is called.
     # 
@@ -113,27 +125,44 @@ def run():
     except:
         sht20 = None
 
-    cloud = nRFCloudMQTT(nic, mqtt_device_id)
-    cloud.connect()
-    if cloud.isconnected():
-        # Send data with the current device information
-        cloud.d2c({'appId':'DEVICE','messageType':'DATA','data': {
-            'deviceInfo': {
-                'board': board.BOARD_NAME,
-                'appName': 'MicroPython Tracker',
-                'appVersion': 'v1.1',
-                'imei': nic.status('imei')
-            },
-            'serviceInfo': {
-                'ui': ['GPS', 'TEMP', 'BUTTON']
-            },
-            'simInfo': {
-                'uiccMode': nic.status('uiccMode'),
-                'iccid': nic.status('iccid'),
-                'imsi': nic.status('imsi')
-            }
-            }
-        })
+    # Data that can't be sent while the connection is down is kept on flash and sent on reconnect
+    # The server address is kept on flash so reconnecting (also after a reboot) skips the DNS lookup
+    addr_cache = AddrCache('/flash/addr_cache')
+    # The device information reported to the shadow is remembered on flash, so only changes are sent,
+    # and so is the topic prefix, so connecting doesn't wait for the shadow. Cell locations are
+    # cached too, a device that stays in the same cells doesn't ask nRF Cloud again, and so is the A-GNSS
+    # data, which is only requested again when it expires. Ephemerides come from a week of P-GPS predictions
+    cloud = nRFCloudMQTT(nic, mqtt_device_id, queue=MQTTQueue('/flash/d2c_queue'), addr_cache=addr_cache,
+                         state_path='/flash/shadow_reported.json', prefix_path='/flash/nrfcloud_prefix.json',
+                         fix_cache=GroundFixCache('/flash/ground_fix_cache'), agnss_cache=AGNSSCache('/flash/agnss'),
+                         pgps=PGPSStore('/flash/pgps'))
+    link = Supervisor(cloud.connect, cloud.isconnected, addr_cache)
+    cloud.stats_interval = 3600     # Report the MQTT statistics once an hour
+    cloud.extra_stats = link.stats  # with the reconnection statistics
+    cloud.clean_session = False     # Keep the subscriptions on the broker, reconnects don't subscribe again
+    # The periodic messages are sent as compact JSON with a fixed number of decimals
+    compact = JSONCodec(TRACKER_PRECISION)
+    for app in ('GNSS', 'TEMP', 'HUMID'):
+        cloud.codecs[app] = compact
+    # Report the current device information. Only what changed since the last
+    # report acknowledged by nRF Cloud is sent, so usually nothing after a reboot.
+    cloud.report({'device': {
+        'deviceInfo': {
+            'board': board.BOARD_NAME,
+            'appName': 'MicroPython Tracker',
+            'appVersion': 'v1.1',
+            'imei': nic.status('imei')
+        },
+        'serviceInfo': {
+            'ui': ['GPS', 'TEMP', 'BUTTON']
+        },
+        'simInfo': {
+            'uiccMode': nic.status('uiccMode'),
+            'iccid': nic.status('iccid'),
+            'imsi': nic.status('imsi')
+        }
+    }})
+    link.poll()
 
     board.button1.irq(lambda pin: button_publish(pin, cloud))
     nic.config(edrx=(81.92,5.12), edrx_enable=True)     # Set eDRX
@@ -145,7 +174,8 @@ def run():
         time.sleep(3)
 
     while True:
-        time.sleep(1)
+        # Wake up at least once a second for the IRQ messages, and exactly when the keepalive is due
+        time.sleep_ms(cloud.next_wakeup(1000))
         if cloud.isconnected():
             if len(publish_msg):
                 task = publish_msg.popleft()
@@ -163,23 +193,27 @@ def run():
                         # Now let's add some additional data, it can be any valid key/value pair.
                         # The extra data is not shown on the nRF Cloud portal, but it can be retrieved via REST API
                         msg['data']['extra'] = 80
-                        cloud.d2c(msg)
+                        # The location and the sensor readings go out together as one bulk upload
+                        # (a single PUBLISH with QoS 1). cloud.process() collects the PUBACK.
+                        cloud.bulk(msg)
 
                         # Let's publish temperature and humidity if the sensor is present
                         if sht20:
-                            cloud.d2c({"appId":"TEMP", "messageType": "DATA", "data": sht20.temperature()})
-                            cloud.d2c({"appId":"HUMID", "messageType": "DATA", "data": sht20.humidity()})
+                            cloud.bulk({"appId":"TEMP", "messageType": "DATA", "data": sht20.temperature()})
+                            cloud.bulk({"appId":"HUMID", "messageType": "DATA", "data": sht20.humidity()})
+                        cloud.flush_bulk()
                     elif task[1] == 'cell':
                         # We don't need to publish location because Cell location is saved by nRF Cloud when
                         # the device sends the cell data to nRF Cloud for location information
 
-                        # Let's publish temperature and humidity if the sensor is present
+                        # Let's publish temperature and humidity if the sensor is present. They are
+                        # collected with their timestamps and sent when the bulk upload is full or old enough.
                         if sht20:
-                            cloud.d2c({"appId":"TEMP", "messageType": "DATA", "data": sht20.temperature()})
-                            cloud.d2c({"appId":"HUMID", "messageType": "DATA", "data": sht20.humidity()})
+                            cloud.bulk({"appId":"TEMP", "messageType": "DATA", "data": sht20.temperature()})
+                            cloud.bulk({"appId":"HUMID", "messageType": "DATA", "data": sht20.humidity()})
                 elif task[0] == _IRQ_CELL_UPDATE:
-                    # We have a new Cell ID, so let's get the latest network status
-                    msg = {'appId':'DEVICE','messageType':'DATA','data': {
+                    # We have a new Cell ID, so let's report the latest network status (only the values that changed)
+                    cloud.report({'device': {
                         'networkInfo': {
                             'cellID': task[1][0],
                             'areaCode': task[1][1],
@@ -188,8 +222,7 @@ def run():
                             'ipAddress': nic.status('ipAddress'),
                             'networkMode': 'LTE-M' if nic.status('mode') == network.LTE_MODE_LTEM else 'NB-IoT'
                         }
-                    }}
-                    cloud.d2c(msg)
+                    }})
                 elif task[0] == _IRQ_GNSS_ASSISTANCE_REQUEST:
                     cloud.agnss_request(task[1])
                 elif task[0] == _IRQ_CELL_LOCATION_REQUEST:
@@ -201,10 +234,10 @@ def run():
             # This is needed for the MQTT Client to properly handle the keep alive as well
             # as any incoming messages (although this demo doesn't have any incoming messages)
             cloud.process()
-        else:
-            time.sleep(30)   # Additional delay for reconnections to give the network time to recover
-            if nic.isconnected():
-                cloud.connect()
+        elif link.poll():
+            # Retries back off exponentially, but a new network registration triggers one right away.
+            # The reconnection statistics go to the cloud with the hourly report.
+            print(f'Reconnected: {link.stats()}')
 
 def provision():
     mqtt_device_id = f'nrf-{nic.status("imei")}'
@@ -1,6 +1,7 @@
 from micropython import const
-from umqtt import MQTTClient
+from umqtt import MQTTClient, AsyncMQTTClient
 import network
+import asyncio
 import time
 from machine import Pin
 import nrf9160dk as board
@@ -63,5 +64,47 @@ def run():
     finally:
         c.disconnect()
 
+# Same as run(), using the asyncio client: incoming messages are handled as soon as
+# they arrive instead of once per second, and the device is idle otherwise.
+async def run_async():
+    nic = network.CELL()
+    check_cacert(nic)
+    if not nic.isconnected():
+        nic.connect()
+        while not nic.isconnected():
+            await asyncio.sleep(1)
+
+    await asyncio.sleep_ms(200)
+
+    c = AsyncMQTTClient("umqtt_client", MQTT_SERVER, keepalive=60, ssl=True, ssl_params={'sec_tag': DEFAULT_SEC_TAG})
+    if await c.connect() < 0:
+        print("MQTT connection failed")
+        return
+    try:
+        await c.subscribe(MQTT_SUB_TOPIC)
+
+        # Button presses are signalled from the IRQ handler and published from a task
+        pressed = asyncio.ThreadSafeFlag()
+        last = [None]
+        def on_button(p):
+            if p.value() == 0:
+                last[0] = p
+                pressed.set()
+        board.button1.irq(on_button)
+        board.button2.irq(on_button)
+
+        async def publish_buttons():
+            while True:
+                await pressed.wait()
+                await c.publish(MQTT_PUB_TOPIC, b"1" if last[0] == board.button1 else b"2")
+
+        asyncio.create_task(publish_buttons())
+        print("MQTT connection established")
+
+        async for topic, msg in c:
+            mqtt_callback(topic, msg)
+    finally:
+        await c.disconnect()
+
 if __name__ == "__main__":
     run()
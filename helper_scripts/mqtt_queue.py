@@ -0,0 +1,210 @@
+# Persistent outbound queue for MQTT messages that could not be published.
+#
+# Messages are appended as compact binary records to a set of segment files on
+# flash (<path>.0 ... <path>.N-1) used as a ring. Files are only ever appended to,
+# and a segment is truncated and reused as a whole once the ring wraps around, so
+# no flash block is rewritten in place. Draining appends a small mark with the
+# sequence number of the last message sent instead of modifying the records.
+#
+# When a segment that still holds unsent messages is reused, they are evicted:
+# oldest first by default. With keep_prio set, messages with a priority of at
+# least keep_prio are carried over into the reused segment (up to half of it),
+# behind the newer messages.
+
+import os
+import ustruct as struct
+from array import array
+
+_REC = 0xA5     # Message record
+_MARK = 0xD7    # Drain mark: messages up to seq have been sent
+_HDR = "<BBIBH"  # magic, flags (prio | retain << 4 | qos << 5), seq, topic len, payload len
+_HDR_LEN = 9
+
+
+class MQTTQueue:
+    def __init__(self, path="/flash/mqtt_queue", size=16384, segments=4, keep_prio=None):
+        self.path = path
+        self.seg_size = size // segments
+        self.segments = segments
+        self.keep_prio = keep_prio
+        self.queued = 0
+        self.dropped = 0
+        self.drained = 0
+        self._hdr = bytearray(_HDR_LEN)
+        self._seq = 0           # Last sequence number used
+        self._sent = 0          # Last sequence number drained
+        self._count = 0         # Messages waiting
+        self._cur = 0           # Segment being appended to
+        self._cur_len = 0
+        self._seg_max = array("I", [0] * segments)  # Highest seq of each segment
+        self._load()
+
+    def _name(self, n):
+        return "%s.%d" % (self.path, n)
+
+    # Yield (offset, magic, flags, seq, topic, msg) for the valid records and marks of a
+    # segment, offset being where the entry ends. Scanning stops at the first record
+    # that is cut short (e.g. power loss).
+    def _scan(self, n, data=False):
+        try:
+            f = open(self._name(n), "rb")
+        except OSError:
+            return
+        with f:
+            end = self._seg_len(n)
+            off = 0
+            while True:
+                h = f.read(_HDR_LEN)
+                if len(h) < _HDR_LEN:
+                    return
+                magic, flags, seq, tl, pl = struct.unpack(_HDR, h)
+                if magic == _MARK:
+                    off += _HDR_LEN
+                    yield off, magic, flags, seq, None, None
+                    continue
+                if magic != _REC:
+                    return
+                if data:
+                    topic = f.read(tl)
+                    msg = f.read(pl)
+                    if len(msg) < pl:
+                        return
+                else:
+                    f.seek(tl + pl, 1)
+                    topic = msg = None
+                off += _HDR_LEN + tl + pl
+                if off > end:
+                    return
+                yield off, magic, flags, seq, topic, msg
+
+    def _seg_len(self, n):
+        try:
+            return os.stat(self._name(n))[6]
+        except OSError:
+            return 0
+
+    def _load(self):
+        end = [0] * self.segments
+        for n in range(self.segments):
+            for off, magic, flags, seq, topic, msg in self._scan(n):
+                end[n] = off
+                if magic == _MARK:
+                    self._sent = max(self._sent, seq)
+                else:
+                    self._seg_max[n] = max(self._seg_max[n], seq)
+                self._seq = max(self._seq, seq)
+        for n in range(self.segments):
+            if self._seg_max[n] == self._seq and self._seq:
+                self._cur = n
+                # Don't append after a damaged record, move on to the next segment instead
+                self._cur_len = end[n] if end[n] == self._seg_len(n) else self.seg_size
+        for n in range(self.segments):
+            for off, magic, flags, seq, topic, msg in self._scan(n):
+                if magic == _REC and seq > self._sent:
+                    self._count += 1
+
+    # Number of messages waiting to be sent
+    def pending(self):
+        return self._count
+
+    def _append(self, f, magic, flags, seq, topic, msg):
+        struct.pack_into(_HDR, self._hdr, 0, magic, flags, seq, len(topic), len(msg))
+        f.write(self._hdr)
+        if magic == _REC:
+            f.write(topic)
+            f.write(msg)
+            self._seg_max[self._cur] = seq
+        self._cur_len += _HDR_LEN + len(topic) + len(msg)
+
+    # Move to the next segment, evicting whatever it still holds
+    def _next_segment(self):
+        self._cur = (self._cur + 1) % self.segments
+        keep = []
+        if self._seg_max[self._cur] > self._sent:
+            kept = 0
+            for off, magic, flags, seq, topic, msg in self._scan(self._cur, True):
+                if magic != _REC or seq <= self._sent:
+                    continue
+                size = _HDR_LEN + len(topic) + len(msg)
+                if self.keep_prio is not None and flags & 0xF >= self.keep_prio and kept + size <= self.seg_size // 2:
+                    keep.append((flags, topic, msg))
+                    kept += size
+                else:
+                    self.dropped += 1
+                self._count -= 1
+        self._seg_max[self._cur] = 0
+        self._cur_len = 0
+        with open(self._name(self._cur), "wb") as f:
+            # A drain mark first, so the segment can be recognised even if it ends up empty
+            self._append(f, _MARK, 0, self._sent, b"", b"")
+            for flags, topic, msg in keep:
+                self._seq += 1
+                self._append(f, _REC, flags, self._seq, topic, msg)
+                self._count += 1
+
+    # Store a message. prio (0-15) is used when keep_prio is set.
+    # Returns False if the message is larger than a segment.
+    def put(self, topic, msg, retain=False, qos=0, prio=0):
+        if hasattr(topic, "name"):      # umqtt.Topic
+            topic = topic.name
+        size = _HDR_LEN + len(topic) + len(msg)
+        if size + _HDR_LEN > self.seg_size:
+            self.dropped += 1
+            return False
+        if self._cur_len + size > self.seg_size:
+            self._next_segment()
+        with open(self._name(self._cur), "ab") as f:
+            self._seq += 1
+            self._append(f, _REC, prio & 0xF | retain << 4 | qos << 5, self._seq, topic, msg)
+        self._count += 1
+        self.queued += 1
+        return True
+
+    # Send up to batch waiting messages, oldest first, with publish(topic, msg, retain, qos)
+    # (e.g. MQTTClient.publish) and record them as sent. Returns the number of messages
+    # sent. Publish errors are raised; messages sent before the error are not sent again.
+    def drain(self, publish, batch=8):
+        n = 0
+        last = self._sent
+        try:
+            for i in range(1, self.segments + 1):
+                seg = (self._cur + i) % self.segments
+                if self._seg_max[seg] <= self._sent:
+                    continue
+                # Closed explicitly: the segment file stays open until the
+                # generator finishes, and MicroPython only frees it on GC
+                records = self._scan(seg, True)
+                try:
+                    for off, magic, flags, seq, topic, msg in records:
+                        if magic != _REC or seq <= last:
+                            continue
+                        if n == batch:
+                            return n
+                        publish(topic, msg, flags >> 4 & 1, flags >> 5 & 3)
+                        last = seq
+                        n += 1
+                finally:
+                    records.close()
+        finally:
+            if n:
+                self._mark(last, n)
+        return n
+
+    # Marks always go to the current segment, even if it is full: moving to the
+    # next one could evict messages. They are small and only written per batch.
+    def _mark(self, seq, n):
+        with open(self._name(self._cur), "ab") as f:
+            self._append(f, _MARK, 0, seq, b"", b"")
+        self._sent = seq
+        self._count -= n
+        self.drained += n
+
+    def clear(self):
+        for n in range(self.segments):
+            try:
+                os.remove(self._name(n))
+            except OSError:
+                pass
+            self._seg_max[n] = 0
+        self._count = 0
+        self._cur_len = 0
@@ -0,0 +1,149 @@
+# Reconnection helpers for MQTT over cellular.
+#
+# AddrCache keeps the addresses returned by DNS in a small file on flash, so a
+# reconnect (also after a reboot) can skip the lookup:
+#
+#   cache = AddrCache('/flash/addr_cache')
+#   client.resolver = cache.resolve
+#
+# Supervisor brings the connection back after it drops. Attempts are spaced
+# with exponential backoff and jitter, and the next attempt is made right away
+# when the modem reports it is registered to the network again:
+#
+#   link = Supervisor(cloud.connect, cloud.isconnected, cache)
+#   # In the _IRQ_NW_REG_STATUS handler:
+#   link.nw_update(data)
+#   # In the main loop:
+#   link.poll()
+
+import json
+import random
+import socket
+import time
+
+
+class AddrCache:
+    def __init__(self, path="/flash/addr_cache", ttl=86400):
+        self.path = path
+        self.ttl = ttl          # Seconds an address is used before it is looked up again
+        self.lookups = 0
+        self.hits = 0
+        self._last = None       # Key of the last address returned
+        try:
+            with open(path) as f:
+                self._addrs = json.load(f)
+        except (OSError, ValueError):
+            self._addrs = {}
+
+    def _save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self._addrs, f)
+        except OSError:
+            pass
+
+    # Return the address of server:port, from the cache if it is still valid.
+    # An entry from before the clock was set (e.g. after a reboot) is used too:
+    # if the address turns out to be wrong the connection fails and the
+    # supervisor calls invalidate().
+    def resolve(self, server, port):
+        key = self._last = "%s:%d" % (server, port)
+        e = self._addrs.get(key)
+        if e:
+            age = time.time() - e[2]
+            if age < self.ttl:
+                self.hits += 1
+                return (e[0], e[1])
+        self.lookups += 1
+        addr = socket.getaddrinfo(server, port)[0][-1]
+        if isinstance(addr, tuple):
+            self._addrs[key] = [addr[0], addr[1], time.time()]
+            self._save()
+        return addr
+
+    # Drop the entry of server:port, by default the last one returned by resolve()
+    def invalidate(self, server=None, port=None):
+        key = self._last if server is None else "%s:%d" % (server, port)
+        if self._addrs.pop(key, None):
+            self._save()
+
+
+class Supervisor:
+    # connect() returns a negative value on failure (MQTTClient.connect,
+    # nRFCloudMQTT.connect). cache is the AddrCache used by the client, the
+    # address it returned last is dropped when a connection attempt fails.
+    def __init__(self, connect, isconnected, cache=None, backoff_min=2, backoff_max=600):
+        self.connect = connect
+        self.isconnected = isconnected
+        self.cache = cache
+        self.backoff_min = backoff_min * 1000
+        self.backoff_max = backoff_max * 1000
+        self._backoff = self.backoff_min
+        self._next = time.ticks_ms()
+        self._down = None       # When the connection was found down, None while connected
+        self._registered = True
+        self._first = True      # The first connection is not a reconnection
+        # Statistics, times in ms
+        self.attempts = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.ttr_last = 0
+        self.ttr_max = 0
+        self.ttr_total = 0
+
+    # Call from the _IRQ_NW_REG_STATUS handler with the registration status
+    # (1: home network, 5: roaming). Registering makes the next poll() try
+    # right away instead of waiting for the backoff.
+    def nw_update(self, status):
+        self._registered = status in (1, 5)
+        if self._registered:
+            self._backoff = self.backoff_min
+            self._next = time.ticks_ms()
+
+    # Try to reconnect if the connection is down and an attempt is due.
+    # Returns True when connected.
+    def poll(self):
+        if self.isconnected():
+            return True
+        now = time.ticks_ms()
+        if self._down is None:
+            self._down = now
+            self._next = now
+        if not self._registered or time.ticks_diff(now, self._next) < 0:
+            return False
+        self.attempts += 1
+        if self.connect() >= 0 and self.isconnected():
+            if not self._first:
+                ttr = time.ticks_diff(time.ticks_ms(), self._down)
+                self.reconnects += 1
+                self.ttr_last = ttr
+                self.ttr_max = max(self.ttr_max, ttr)
+                self.ttr_total += ttr
+            self._first = False
+            self._down = None
+            self._backoff = self.backoff_min
+            return True
+        self.failures += 1
+        if self.cache:
+            self.cache.invalidate()
+        # Wait between half and all of the current backoff, then double it. 24
+        # random bits cover the largest backoff (ms) with little modulo bias.
+        self._next = time.ticks_add(time.ticks_ms(), self._backoff // 2 + random.getrandbits(24) % (self._backoff // 2 + 1))
+        self._backoff = min(self._backoff * 2, self.backoff_max)
+        return False
+
+    # Milliseconds until the next reconnection attempt, 0 if connected
+    def next_attempt(self):
+        if self._down is None:
+            return 0
+        return max(0, time.ticks_diff(self._next, time.ticks_ms()))
+
+    def stats(self):
+        return {
+            "attempts": self.attempts,
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+            "ttr_last_ms": self.ttr_last,
+            "ttr_max_ms": self.ttr_max,
+            "ttr_avg_ms": self.ttr_total // self.reconnects if self.reconnects else 0,
+        }
@@ -1,69 +1,728 @@
-from umqtt import MQTTClient
+from umqtt import MQTTClient, MQTTException
+from payload_codec import JSONCodec
 import json
+import os
+import socket
 import time
+import ustruct as struct
 
 # Get the _TEAM_ID value from your Team ID in nRF Cloud. Leave "" to use the shadow
 _TEAM_ID = ""
 _MQTT_KEEPALIVE = 1200    # in seconds
+_MQTT_INFLIGHT = 4        # QoS 1 messages that can be waiting for their PUBACK
+_MQTT_VERSION = 5         # MQTT 5 lets the d2c topic shrink to a 2-byte topic alias; 4 for MQTT 3.1.1
+_AGNSS_BUF_SIZE = 4096    # A-GNSS responses up to this size are received without allocating
+_MQTT_TX_BUF = 512        # Fits the SUBSCRIBE with all the nRF Cloud topics
+_SHADOW_TIMEOUT = 10000   # ms to wait for the shadow when connecting
+_SUBACK_TIMEOUT = 10000   # and for each SUBACK
+_QUEUE_BATCH = 8          # Queued messages sent per batch after reconnecting
+_BULK_MAX_MSGS = 16       # Limits of a bulk upload: messages,
+_BULK_MAX_BYTES = 2048    # bytes of JSON,
+_BULK_MAX_AGE = 300       # and seconds since its first message was added
+# MicroPython ports with a 2000 epoch
+_EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+# GPS time: seconds since 1980-01-06, without the leap seconds of UTC
+_GPS_EPOCH = 315964800
+_GPS_LEAP = 18
+# Requests to nRF Cloud services, which must reach the cloud as plain JSON
+_SERVICE_APPS = ('AGNSS', 'GROUND_FIX', 'PGPS')
+
+
+# Keys of new whose values differ from old, recursing into dicts
+def _diff(new, old):
+    out = {}
+    for k, v in new.items():
+        o = old.get(k)
+        if isinstance(v, dict):
+            # Copied, so later changes to new don't end up in the diff
+            d = _diff(v, o if isinstance(o, dict) else {})
+            if d or not isinstance(o, dict):
+                out[k] = d
+        elif k not in old or o != v:
+            out[k] = v
+    return out
+
+
+def _merge(dst, src):
+    for k, v in src.items():
+        if isinstance(v, dict):
+            if not isinstance(dst.get(k), dict):
+                dst[k] = {}
+            _merge(dst[k], v)
+        else:
+            dst[k] = v
+
+
+# Serving cell of an 'lte' entry of a GROUND_FIX request, and its neighbors
+def _cell_key(cell):
+    return "%d:%d:%d:%d" % (cell['mcc'], cell['mnc'], cell['tac'], cell['eci'])
+
+
+def _neighbors(cell):
+    return sorted([n['pci'], n['earfcn']] for n in cell.get('nmr', ()))
+
+
+# Locations returned by GROUND_FIX for the cells seen, so a device that hasn't
+# moved doesn't ask the cloud again. Entries are looked up by serving cell
+# (mcc, mnc, tac, eci) and only used if the neighbor cells measured now are
+# similar enough to the ones seen when the entry was made (Jaccard index of
+# the (pci, earfcn) sets). At most size entries are kept, the least recently
+# used is dropped first, and they are used for ttl seconds. The entries are
+# kept in a file on flash. The cache is not used until the clock is set, as
+# the age of the entries can't be told before.
+class GroundFixCache:
+    def __init__(self, path="/flash/ground_fix_cache", size=16, ttl=7 * 86400, similarity=0.5):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.misses = 0
+        self._use = 0
+        # key -> [lat, lon, uncertainty, time, neighbors, last use]
+        try:
+            with open(path) as f:
+                self._fixes = json.load(f)
+        except (OSError, ValueError):
+            self._fixes = {}
+        for e in self._fixes.values():
+            self._use = max(self._use, e[5])
+
+    def _save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self._fixes, f)
+        except OSError:
+            pass
+
+    def _similar(self, a, b):
+        if not a and not b:
+            return True
+        a = set(tuple(n) for n in a)
+        b = set(tuple(n) for n in b)
+        return len(a & b) / len(a | b) >= self.similarity
+
+    # Unix time, or None while the clock is not set
+    def _now(self):
+        now = int(time.time())
+        return now if now + _EPOCH_OFFSET > 1577836800 else None
+
+    # (lat, lon, uncertainty) for the cell (an 'lte' entry of a GROUND_FIX
+    # request), or None
+    def get(self, cell):
+        now = self._now()
+        e = self._fixes.get(_cell_key(cell)) if now is not None else None
+        if e and 0 <= now - e[3] < self.ttl and self._similar(e[4], _neighbors(cell)):
+            self.hits += 1
+            self._use += 1
+            e[5] = self._use
+            return (e[0], e[1], e[2])
+        self.misses += 1
+        return None
+
+    def put(self, cell, lat, lon, uncertainty):
+        now = self._now()
+        if now is None:
+            return
+        key = _cell_key(cell)
+        if key not in self._fixes and len(self._fixes) >= self.size:
+            lru = None
+            for k, e in self._fixes.items():
+                if lru is None or e[5] < self._fixes[lru][5]:
+                    lru = k
+            del self._fixes[lru]
+        self._use += 1
+        self._fixes[key] = [lat, lon, uncertainty, now, _neighbors(cell), self._use]
+        self._save()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._fixes)}
+
+
+# Size of one item of each A-GNSS element type in the binary format of nRF
+# Cloud (schema 1): UTC parameters, ephemerides, almanacs, Klobuchar and NeQuick
+# ionospheric corrections, GPS TOW, system time and TOWs, location, integrity
+_AGNSS_ITEM = {1: 14, 2: 62, 3: 31, 4: 8, 5: 8, 6: 3, 7: 108, 8: 15, 9: 4}
+# Seconds each type is kept and injected again. Time, location and integrity
+# are always requested from the cloud.
+_AGNSS_TTL = {1: 86400, 2: 2 * 3600, 3: 7 * 86400, 4: 86400, 5: 86400}
+
+
+# A-GNSS elements received from nRF Cloud, kept on flash (one file per type,
+# path + ".<type>") while they are valid. When the modem asks for assistance
+# again, the types still valid are injected from here and only the others
+# are requested. Ephemerides are filtered for the location of the device, so
+# they are only kept for 2 hours. Nothing is used before the clock is set.
+class AGNSSCache:
+    def __init__(self, path="/flash/agnss", ttl=None):
+        self.path = path
+        self.ttl = ttl or _AGNSS_TTL
+        self.requests = 0       # Requests from the modem
+        self.served = 0         # and how many were answered without the cloud
+        self.bytes_saved = 0
+        self.rejected = 0       # Responses that could not be parsed, not cached
+
+    def _now(self):
+        now = int(time.time())
+        return now if now + _EPOCH_OFFSET > 1577836800 else None
+
+    # Split the types asked for by the modem: returns the cached data that is
+    # still valid, as an nRF Cloud A-GNSS blob (None if there is none), and the
+    # types to request from the cloud
+    def lookup(self, types):
+        self.requests += 1
+        now = self._now()
+        blob = None
+        missing = []
+        for t in types:
+            data = None
+            if now is not None and t in self.ttl:
+                try:
+                    with open("%s.%d" % (self.path, t), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    pass
+            if data and 0 <= now - struct.unpack_from("<I", data)[0] < self.ttl[t]:
+                if blob is None:
+                    blob = bytearray(b"\x01")    # Schema version
+                blob += memoryview(data)[4:]
+            else:
+                missing.append(t)
+        if blob:
+            self.bytes_saved += len(blob) - 1
+            if not missing:
+                self.served += 1
+        return blob, missing
+
+    # Store the elements of an A-GNSS response that can be cached. The
+    # response is only used if it parses to its exact end.
+    def put(self, data):
+        now = self._now()
+        if now is None or not data or data[0] != 1:
+            return
+        elements = []
+        p = 1
+        while p + 3 <= len(data):
+            t = data[p]
+            n = data[p + 1] | data[p + 2] << 8
+            size = _AGNSS_ITEM.get(t)
+            if size is None or p + 3 + n * size > len(data):
+                break
+            elements.append((t, p, p + 3 + n * size))
+            p += 3 + n * size
+        if p != len(data):
+            self.rejected += 1
+            return
+        stamp = struct.pack("<I", now)
+        for t, start, end in elements:
+            if t in self.ttl:
+                try:
+                    with open("%s.%d" % (self.path, t), "wb") as f:
+                        f.write(stamp)
+                        f.write(data[start:end])
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {"requests": self.requests, "served": self.served, "bytes_saved": self.bytes_saved,
+                "rejected": self.rejected}
+
+
+def _gps_time():
+    now = time.time() + _EPOCH_OFFSET
+    if now < 1577836800:    # The clock has not been set
+        return None
+    return int(now) - _GPS_EPOCH + _GPS_LEAP
+
+
+def _readinto(s, buf):
+    mv = memoryview(buf)
+    n = 0
+    while n < len(mv):
+        k = s.readinto(mv[n:])
+        if not k:
+            raise OSError(-1)
+        n += k
+
+
+# Predicted GPS ephemerides (P-GPS) from nRF Cloud, kept in a file on flash.
+#
+# nRF Cloud answers a PGPS request with the location of a file holding count
+# predictions, one every period minutes, that is downloaded over HTTPS.
+# download() keeps the ephemerides of each prediction in a file indexed by
+# prediction:
+#
+#   header   <BHHHI  version, count, period (min), GPS day, GPS time of day (s)
+#   index    <I      offset of each prediction, count + 1 entries
+#   records          ephemeris element of each prediction (A-GNSS format)
+#
+# lookup() returns the ephemerides of the prediction for the current time as an
+# A-GNSS blob for nic.agnss_data(). The system time of the predictions is not
+# injected, the modem has the time from the network.
+#
+# The downloaded file follows the nRF Connect SDK P-GPS schema v1
+# (nrf_cloud_pgps_schema_v1.h): a 14-byte header, then count predictions of
+# _PGPS_PRED_SIZE bytes each:
+#
+#   header      <bBHHHHI  schema version, type 22, items (1), count, period,
+#                         GPS day, GPS time of day
+#   prediction  <B        schema version
+#               <BH       type 7 (system clock), 1 item
+#               16 bytes  date_day u16, time_full_s u32, time_frac_ms u16,
+#                         sv_mask u32, pad u32
+#               <BH       type 2 (ephemerides), 32 items of 62 bytes
+#               <I        sentinel 0xDEADBEEF
+# P-GPS file: header type, satellites per prediction and end of each prediction
+_PGPS_HEADER = 22
+_PGPS_NUM_SV = 32
+_PGPS_SENTINEL = 0xDEADBEEF
+_PGPS_EPH_SIZE = 3 + _PGPS_NUM_SV * 62      # Ephemeris element of a prediction
+_PGPS_PRED_SIZE = 1 + 3 + 16 + _PGPS_EPH_SIZE + 4
+
+
+class PGPSStore:
+    def __init__(self, path="/flash/pgps", count=42, period=240, sec_tag=16842753):
+        self.path = path
+        self.count = count      # Predictions requested (42 every 4 hours: one week)
+        self.period = period
+        self.sec_tag = sec_tag  # Used for the HTTPS download
+        self.downloads = 0
+        self.bytes_downloaded = 0
+        self.injected = 0
+
+    # Index of the prediction for the current time, and the number of predictions
+    def _current(self, f):
+        ver, count, period, day, tod = struct.unpack("<BHHHI", f.read(11))
+        now = _gps_time()
+        if ver != 1 or now is None:
+            return -1, count
+        return (now - (day * 86400 + tod)) // (period * 60), count
+
+    # Predictions left from the current one, 0 if there are none
+    def remaining(self):
+        try:
+            with open(self.path, "rb") as f:
+                i, count = self._current(f)
+        except (OSError, ValueError):
+            return 0
+        return count - i if 0 <= i < count else 0
+
+    def lookup(self):
+        try:
+            with open(self.path, "rb") as f:
+                i, count = self._current(f)
+                if not 0 <= i < count:
+                    return None
+                f.seek(11 + 4 * i)
+                start, end = struct.unpack("<II", f.read(8))
+                f.seek(start)
+                blob = bytearray(1 + end - start)
+                blob[0] = 1     # A-GNSS schema version
+                f.readinto(memoryview(blob)[1:])
+        except (OSError, ValueError):
+            return None
+        self.injected += 1
+        return blob
+
+    # Download the predictions from https://host/path into the file. The
+    # previous file is kept until the download is complete.
+    def download(self, host, path):
+        addr = socket.getaddrinfo(host, 443)[0][-1]
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TLS_1_2)
+        try:
+            s.tlswrap(self.sec_tag, hostname=host)
+            s.connect(addr)
+            s.write(("GET /%s HTTP/1.0\r\nHost: %s\r\n\r\n" % (path.lstrip("/"), host)).encode())
+            status = s.readline().split()
+            if len(status) < 2 or status[1] != b"200":
+                raise OSError("P-GPS download failed: %s" % status)
+            while s.readline() not in (b"\r\n", b""):
+                pass
+            self._store(s)
+        finally:
+            s.close()
+        self.downloads += 1
+
+    # Parse the P-GPS file from stream s (see the layout above), keeping the
+    # ephemeris element of each prediction
+    def _store(self, s):
+        hdr = bytearray(14)
+        _readinto(s, hdr)
+        ver, kind, items, count, period, day, tod = struct.unpack("<bBHHHHI", hdr)
+        if ver != 1 or kind != _PGPS_HEADER or items != 1:
+            raise ValueError("P-GPS schema")
+        buf = bytearray(_PGPS_PRED_SIZE)
+        eph = memoryview(buf)[20:20 + _PGPS_EPH_SIZE]
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(struct.pack("<BHHHI", 1, count, period, day, tod))
+            f.write(bytes(4 * (count + 1)))
+            index = [11 + 4 * (count + 1)]
+            for _ in range(count):
+                _readinto(s, buf)
+                ver, t, n = struct.unpack_from("<BBH", buf, 0)
+                if ver != 1 or t != 7 or n != 1:
+                    raise ValueError("P-GPS prediction")
+                t, n = struct.unpack_from("<BH", buf, 20)
+                sentinel = struct.unpack_from("<I", buf, _PGPS_PRED_SIZE - 4)[0]
+                if t != 2 or n != _PGPS_NUM_SV or sentinel != _PGPS_SENTINEL:
+                    raise ValueError("P-GPS prediction")
+                f.write(eph)
+                index.append(index[-1] + _PGPS_EPH_SIZE)
+            f.seek(11)
+            for off in index:
+                f.write(struct.pack("<I", off))
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        os.rename(tmp, self.path)
+        self.bytes_downloaded += 14 + count * _PGPS_PRED_SIZE
+
+    def stats(self):
+        return {"downloads": self.downloads, "bytes_downloaded": self.bytes_downloaded,
+                "injected": self.injected, "remaining": self.remaining()}
+
 
 class nRFCloudMQTT:
     State = {"DISCONNECTED": 0, "CONNECTED": 1, "SHADOW_RETRIEVED": 2, "UNPAIRED": 3, "PAIRED": 4}
-    def __init__(self, nic, device_id: str):
+    # queue is an optional mqtt_queue.MQTTQueue: messages that can't be sent are stored
+    # there and sent as soon as the connection is back. addr_cache is an optional
+    # mqtt_reconnect.AddrCache used instead of a DNS lookup on every connect.
+    # compressor is an optional payload_codec.DeflateCodec that compresses JSON d2c
+    # payloads above its threshold; only use it if the receiving side decodes them.
+    # state_path is a file where the last reported shadow state acknowledged by
+    # the cloud is kept, so that report() doesn't send it again after a reboot.
+    # prefix_path is a file where the topic prefix learned from the shadow is kept,
+    # so that connect() doesn't have to wait for the shadow (when _TEAM_ID is "").
+    # fix_cache is an optional GroundFixCache: ground_fix() answers from it when the
+    # cells seen are the same as for an earlier fix, without asking the cloud.
+    # agnss_cache is an optional AGNSSCache: A-GNSS data still valid is injected
+    # from it and only the other types are requested. pgps is an optional
+    # PGPSStore: ephemerides are injected from its predictions instead of
+    # being requested, and new predictions are downloaded when they run out.
+    def __init__(self, nic, device_id: str, queue=None, addr_cache=None, compressor=None, state_path=None,
+                 prefix_path=None, fix_cache=None, agnss_cache=None, pgps=None):
         DEFAULT_SEC_TAG = const(16842753)  # nRF Cloud default sec_tag
         self.nic = nic
         self.device_id = device_id
+        self.queue = queue
+        self.compressor = compressor
+        # Messages are encoded by the codec registered for their appId in codecs
+        # (see payload_codec), or by default_codec. Service requests always use
+        # plain JSON. sizes holds [messages, bytes, last size] per appId.
+        self.default_codec = JSONCodec(compact=False)
+        self.codecs = {}
+        self.sizes = {}
+        # Bulk upload: messages added with bulk() are sent together as one
+        # JSON array on the d2c/bulk topic
+        self.bulk_max_msgs = _BULK_MAX_MSGS
+        self.bulk_max_bytes = _BULK_MAX_BYTES
+        self.bulk_max_age = _BULK_MAX_AGE
+        self.bulk_qos = 1
+        self._bulk = []
+        self._bulk_len = 0
+        self._bulk_t = 0
         self.prefix = f'prod/{_TEAM_ID}/'
-        self.mqtt_client = MQTTClient(device_id, "mqtt.nrfcloud.com", keepalive=_MQTT_KEEPALIVE, ssl=True, ssl_params={'sec_tag': DEFAULT_SEC_TAG})
-        self.mqtt_client.set_callback(self._cloud_process)
+        # Prefixes of paired devices by device id, from prefix_path. A cached
+        # prefix is checked against the shadow in the background after the first
+        # connection (_revalidate), and dropped if a publish is rejected. Changes
+        # after that arrive on the delta topic. Seconds after which a reconnect
+        # checks the shadow again, 0: only once per boot
+        self.prefix_check_interval = 0
+        self.prefix_path = prefix_path
+        self._prefixes = {}
+        self._revalidate = False
+        self._checked_at = None
+        self._resubscribe = False
+        if prefix_path:
+            try:
+                with open(prefix_path) as f:
+                    self._prefixes = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self.mqtt_client = MQTTClient(device_id, "mqtt.nrfcloud.com", keepalive=_MQTT_KEEPALIVE, ssl=True, ssl_params={'sec_tag': DEFAULT_SEC_TAG}, max_inflight=_MQTT_INFLIGHT, version=_MQTT_VERSION, tx_buf_size=_MQTT_TX_BUF)
+        if addr_cache:
+            self.mqtt_client.resolver = addr_cache.resolve
         self.status = self.State["DISCONNECTED"]
+        # With clean_session False the broker keeps the subscriptions while the
+        # device is offline (up to the session expiry, MQTT 5) and connect()
+        # doesn't subscribe again when it finds the session present
+        self.clean_session = True
+        self._session_ok = True
+        # Seconds between DEVICE messages with the MQTT statistics, sent from process(). 0: off
+        self.stats_interval = 0
+        # Function returning more statistics for those messages, e.g. Supervisor.stats
+        self.extra_stats = None
+        self._stats_at = time.ticks_ms()
+        self.shadow_get_topic = self.mqtt_client.topic(f'$aws/things/{device_id}/shadow/get')
+        self.shadow_accepted_topic = self.mqtt_client.topic(f'{device_id}/shadow/get/accepted')
+        self.mqtt_client.add_route(self.shadow_accepted_topic, self._on_shadow)
+        # Reported state: report() only sends the keys that differ from what the
+        # cloud has accepted (_acked), and changes of the desired state arrive
+        # as deltas (delta_cb(state) is called with them). A PUBACK only means
+        # the broker took a report: it is accepted when the shadow service
+        # answers on update/accepted with its clientToken.
+        self.shadow_update_topic = self.mqtt_client.topic(f'$aws/things/{device_id}/shadow/update')
+        self.shadow_delta_topic = self.mqtt_client.topic(f'$aws/things/{device_id}/shadow/update/delta')
+        self.shadow_update_accepted_topic = self.mqtt_client.topic(f'$aws/things/{device_id}/shadow/update/accepted')
+        self.shadow_update_rejected_topic = self.mqtt_client.topic(f'$aws/things/{device_id}/shadow/update/rejected')
+        self.mqtt_client.add_route(self.shadow_delta_topic, self._on_delta)
+        self.mqtt_client.add_route(self.shadow_update_accepted_topic, self._on_update_accepted)
+        self.mqtt_client.add_route(self.shadow_update_rejected_topic, self._on_update_rejected)
+        self.mqtt_client.set_puback_callback(self._on_puback)
+        self.delta_cb = None
+        self.state_path = state_path
+        self._acked = {}
+        self._want = {}
+        self._report_pid = 0
+        self._report_diff = None    # Report waiting for the answer of the shadow service
+        self._report_token = 0
+        if state_path:
+            try:
+                with open(state_path) as f:
+                    self._acked = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self.agnss_topic = None
+        self.ground_fix_topic = None
+        self.fix_cache = fix_cache
+        self.agnss_cache = agnss_cache
+        self.pgps = pgps
+        self.pgps_min_left = 6  # New predictions are requested when fewer are left
+        self.pgps_topic = None
+        self._pgps_url = None   # (host, path) of predictions to download from process()
+        self._pgps_pending = False
+        self._fix_cell = None   # Cell of the GROUND_FIX request waiting for its response
+        # A-GNSS responses are several kB. They are received in this buffer so
+        # that each download doesn't allocate (and fragment) heap. Larger ones
+        # (e.g. unfiltered data) are received in a buffer allocated for them.
+        self._agnss_buf = bytearray(_AGNSS_BUF_SIZE)
+        self._rx_dropped = 0
+        self._register_topics()
 
-    def _cloud_process(self, topic, msg):
-        if (topic.decode().endswith('agnss/r')):
-            # Response to AGNSS
-            self.nic.agnss_data(msg)
-        elif (topic.decode().endswith('ground_fix/r')):
-            # Response to SCELL, MCELL, and Wi-Fi location
-            resp = json.loads(msg.decode())
-            if resp['appId'] == 'GROUND_FIX':
-                self.nic.location_cloud_fix(resp['data']['lat'], resp['data']['lon'], resp['data']['uncertainty'])
-        elif (topic.decode().endswith('shadow/get/accepted')):
-            # Response with the shadow, to get topics and pairing status
-            shadow = json.loads(msg.decode())
-            if shadow['desired']['pairing']['state'] != 'paired':
-                self.status = self.State["UNPAIRED"]
-            else:
-                self.prefix = shadow['desired']['nrfcloud_mqtt_topic_prefix']
-                self.status = self.State["PAIRED"]
+    # Topics depend on the prefix, register them again whenever it changes
+    def _register_topics(self):
+        c = self.mqtt_client
+        if self.agnss_topic:
+            c.remove_route(self.agnss_topic)
+            c.remove_route(self.ground_fix_topic)
+            c.remove_route(self.pgps_topic)
+        base = f'{self.prefix}m/d/{self.device_id}/'
+        self.d2c_topic = c.topic(base + 'd2c')
+        self.bulk_topic = c.topic(base + 'd2c/bulk')
+        self.agnss_topic = c.topic(base + 'agnss/r')
+        self.ground_fix_topic = c.topic(base + 'ground_fix/r')
+        self.pgps_topic = c.topic(base + 'pgps/r')
+        c.add_route(self.agnss_topic, self._on_agnss, buf=self._agnss_buf)
+        c.add_route(self.ground_fix_topic, self._on_ground_fix)
+        c.add_route(self.pgps_topic, self._on_pgps)
+
+    def _on_agnss(self, topic, msg):
+        # Response to AGNSS. msg is a memoryview over _agnss_buf, or over a
+        # buffer allocated for it if it is larger
+        if len(msg) > _AGNSS_BUF_SIZE:
+            print(f'A-GNSS response of {len(msg)} bytes is larger than the {_AGNSS_BUF_SIZE} byte buffer')
+        self.nic.agnss_data(msg)
+        if self.agnss_cache:
+            self.agnss_cache.put(msg)
+
+    def _on_pgps(self, topic, msg):
+        # Response to PGPS: where to download the predictions from. That takes a
+        # while, so it is done from process()
+        resp = json.loads(msg)
+        data = resp.get('data', resp)
+        if 'host' in data and 'path' in data:
+            self._pgps_url = (data['host'], data['path'])
+        else:
+            self._pgps_pending = False
+
+    def _on_ground_fix(self, topic, msg):
+        # Response to SCELL, MCELL, and Wi-Fi location
+        resp = json.loads(msg)
+        if resp['appId'] == 'GROUND_FIX':
+            data = resp['data']
+            if self.fix_cache and self._fix_cell and 'lat' in data:
+                self.fix_cache.put(self._fix_cell, data['lat'], data['lon'], data['uncertainty'])
+            self._fix_cell = None
+            self.nic.location_cloud_fix(data['lat'], data['lon'], data['uncertainty'])
+
+    def _on_shadow(self, topic, msg):
+        # Response with the shadow, to get topics and pairing status. Also the
+        # answer to the background check of a cached prefix.
+        shadow = json.loads(msg)
+        self._revalidate = False
+        self._checked_at = time.ticks_ms()
+        if shadow['desired']['pairing']['state'] != 'paired':
+            self._save_prefix(None)
+            if self.status == self.State["PAIRED"]:
+                print(f'Device is unpaired, add it to your nRF Cloud account: {self.device_id}')
+            self.status = self.State["UNPAIRED"]
+        else:
+            self._set_prefix(shadow['desired']['nrfcloud_mqtt_topic_prefix'])
+            self.status = self.State["PAIRED"]
+
+    def _on_delta(self, topic, msg):
+        # The desired state changed: msg holds the keys that differ from reported
+        state = json.loads(msg).get('state', {})
+        prefix = state.get('nrfcloud_mqtt_topic_prefix')
+        if prefix:
+            self._set_prefix(prefix)
+        pairing = state.get('pairing')
+        if pairing and pairing.get('state', 'paired') != 'paired':
+            print(f'Device is unpaired, add it to your nRF Cloud account: {self.device_id}')
+            self._save_prefix(None)
+            self.status = self.State["UNPAIRED"]
+        if self.delta_cb:
+            self.delta_cb(state)
+
+    # Update the reported state of the shadow, e.g. report({'device': {'networkInfo': {...}}}).
+    # Only the keys that changed since the last accepted report are sent, and
+    # nothing at all if none did. While disconnected the state is kept and the
+    # difference is sent after connecting. A rejected report is sent again with
+    # the next report() or connection.
+    def report(self, state: dict) -> int:
+        _merge(self._want, state)
+        return self._send_report()
+
+    def _send_report(self) -> int:
+        if self._report_diff is not None or not self.isconnected():
+            return 0    # Sent when the pending report is accepted, or after connecting
+        diff = _diff(self._want, self._acked)
+        if not diff:
+            return 0
+        self._report_token += 1
+        doc = {'state': {'reported': diff}, 'clientToken': str(self._report_token)}
+        try:
+            pid = self.mqtt_client.publish(self.shadow_update_topic, json.dumps(doc).encode(), qos=1)
+        except:
+            print("Reporting state to nRF Cloud failed")
+            self.disconnect()
+            return -1
+        self._report_pid = pid
+        self._report_diff = diff
+        return 0
+
+    # A new prefix while connected and paired changes the topics subscribed to.
+    # That is done from process(), not from the callback that learned it.
+    def _set_prefix(self, prefix):
+        if prefix != self.prefix:
+            self.prefix = prefix
+            self._register_topics()
+            if self.status == self.State["PAIRED"]:
+                self._resubscribe = True
+        if self._prefixes.get(self.device_id) != prefix:
+            self._save_prefix(prefix)
+
+    # Store the prefix of this device on flash, or forget it with None
+    def _save_prefix(self, prefix):
+        if prefix is None:
+            if self._prefixes.pop(self.device_id, None) is None:
+                return
+        else:
+            self._prefixes[self.device_id] = prefix
+        if self.prefix_path:
+            try:
+                with open(self.prefix_path, 'w') as f:
+                    json.dump(self._prefixes, f)
+            except OSError:
+                pass
+
+    def _on_puback(self, pid):
+        if self.mqtt_client.ack_rc < 0x80:
+            return
+        # Rejected (MQTT 5 reason code, e.g. not authorized): the topics may
+        # not be right, so forget the prefix and check the shadow again
+        if pid == self._report_pid:
+            self._report_pid = 0
+            self._report_diff = None
+        elif self.device_id in self._prefixes:
+            self._save_prefix(None)
+            self._revalidate = True
+
+    # Answers of the shadow service to the pending report, matched on its
+    # clientToken. Returns the state of the report, None if it isn't for it.
+    def _report_answer(self, resp):
+        if self._report_diff is None or resp.get('clientToken') != str(self._report_token):
+            return None
+        diff = self._report_diff
+        self._report_pid = 0
+        self._report_diff = None
+        return diff
+
+    def _on_update_rejected(self, topic, msg):
+        err = json.loads(msg)
+        if self._report_answer(err) is not None:
+            print(f"Shadow update rejected: {err.get('code')} {err.get('message')}")
+
+    def _on_update_accepted(self, topic, msg):
+        diff = self._report_answer(json.loads(msg))
+        if diff is None:
+            return
+        _merge(self._acked, diff)
+        if self.state_path:
+            try:
+                with open(self.state_path, 'w') as f:
+                    json.dump(self._acked, f)
+            except OSError:
+                pass
+        # State reported while this one was in flight
+        self._send_report()
 
     def connect(self) -> int:
-        if self.mqtt_client.connect() == 0:
+        # A session is only resumed if its subscriptions were all made
+        ret = self.mqtt_client.connect(clean_session=self.clean_session or not self._session_ok)
+        if ret >= 0:
             self.status = self.State["CONNECTED"]
+            # Session present: the broker still has the subscriptions
+            present = ret == 1
+            # The shadow answer is subscribed to with the other topics (unless
+            # the cold path below did it), so that the session always has it
+            # for the checks of the prefix
+            shadow = not _TEAM_ID
 
-            # If _TEAM_ID is set to "", then go get the shadow
-            if self.prefix == 'prod//':
-                self.mqtt_client.subscribe(f'{self.device_id}/shadow/get/accepted'.encode())
-                self.get_shadow()
-                retries = 0
-                while self.status < self.State["SHADOW_RETRIEVED"]:
-                    time.sleep_ms(500)
-                    try:
-                        self.mqtt_client.process()
-                    except:
-                        return -1
-                    retries += 1
-                    if retries > 20:       # Wait for 10 seconds
-                        print("Could not retrieve shadow, ensure device is provisioned to your nRF Cloud account")
-                        self.disconnect()
-                        return -1
-            else:       # _TEAM_ID is manually set
+            # If _TEAM_ID is set to "", then use the prefix learned before, or go get the shadow
+            if self.prefix == 'prod//' and self.device_id in self._prefixes:
+                # Checked against the shadow from process(), without waiting for it here
+                self.prefix = self._prefixes[self.device_id]
+                self._register_topics()
+                self.status = self.State["PAIRED"]
+                self._revalidate = self._check_due()
+            elif self.prefix == 'prod//':
+                try:
+                    if not present:
+                        self.mqtt_client.subscribe(self.shadow_accepted_topic, timeout_ms=_SUBACK_TIMEOUT)
+                    shadow = False
+                    self.get_shadow()
+                    got = self.mqtt_client.wait_for(self.shadow_accepted_topic, _SHADOW_TIMEOUT)
+                except:
+                    self.disconnect()
+                    return -1
+                if not got:
+                    print("Could not retrieve shadow, ensure device is provisioned to your nRF Cloud account")
+                    self.disconnect()
+                    return -1
+            else:       # _TEAM_ID is manually set, or this is a reconnect
                 self.status = self.State["PAIRED"]
+                if not _TEAM_ID and self._check_due():
+                    self._revalidate = True
 
             if self.status == self.State["PAIRED"]:
-                # Subscribe to the topics to receive AGNSS and Cellular location
-                self.mqtt_client.subscribe(f'{self.prefix}m/d/{self.device_id}/agnss/r'.encode())
-                self.mqtt_client.subscribe(f'{self.prefix}m/d/{self.device_id}/ground_fix/r'.encode())
+                try:
+                    if not present:
+                        self._subscribe_topics(shadow)
+                except:
+                    print("Subscribing to nRF Cloud topics failed")
+                    self._session_ok = False
+                    self.disconnect()
+                    return -1
+                self._session_ok = True
                 print("Connected to nRF Cloud")
-                return 0
+                # The answer to a report pending on the last connection may be lost, send it again
+                self._report_pid = 0
+                self._report_diff = None
+                self._send_report()
+                return self._drain_queue()
             elif self.status <= self.State["UNPAIRED"]:
                 # Device is not paired, so we are not able to send data
                 print(f'Device is unpaired, add it to your nRF Cloud account: {self.device_id}')
@@ -77,30 +736,178 @@ class nRFCloudMQTT:
             print("Connection to nRF Cloud failed")
             return -1
 
+    # Whether the prefix should be checked against the shadow on this connection
+    def _check_due(self):
+        if self._checked_at is None:
+            return True
+        return self.prefix_check_interval > 0 and time.ticks_diff(time.ticks_ms(), self._checked_at) >= self.prefix_check_interval * 1000
+
+    def _subscribe_topics(self, shadow=False):
+        # Subscribe to the topics to receive AGNSS, P-GPS and Cellular location, in one SUBSCRIBE
+        topics = [(self.agnss_topic, 0), (self.ground_fix_topic, 0), (self.shadow_delta_topic, 0)]
+        if self.pgps:
+            topics.append((self.pgps_topic, 0))
+        topics.append((self.shadow_update_accepted_topic, 0))
+        topics.append((self.shadow_update_rejected_topic, 0))
+        if shadow:
+            topics.append((self.shadow_accepted_topic, 0))
+        codes = self.mqtt_client.subscribe(topics, timeout_ms=_SUBACK_TIMEOUT)
+        for rc in codes:
+            if rc >= 0x80:
+                raise MQTTException(rc)
+
     def disconnect(self) -> None:
+        self.flush_bulk()
+        self._pgps_pending = False
         self.status = self.State["DISCONNECTED"]
         self.mqtt_client.disconnect()
     
     # This uses the Device to Cloud messaging to send the message. See:
     # https://docs.nrfcloud.com/APIs/MQTT/Topics.html#message-topics
-    def d2c(self, msg: dict) -> int:
+    #
+    # With qos=1 the message is acknowledged by nRF Cloud, but d2c() does not wait for it:
+    # several messages can be sent back to back and their PUBACKs are collected by process().
+    # Messages not acknowledged when the connection drops are sent again on reconnect.
+    #
+    # Messages that can't be sent go to the queue, if there is one. Requests to the
+    # location services (AGNSS, GROUND_FIX, PGPS) don't: their answers are only
+    # useful now, so they fail and the caller asks again when it needs to.
+    def d2c(self, msg: dict, qos: int = 0) -> int:
         """ Send a message to nRF Cloud using Device to Cloud messaging """
+        payload = self.encode(msg)
+        queue = self.queue if msg.get('appId') not in _SERVICE_APPS else None
+        if not self.isconnected():
+            if queue:
+                queue.put(b'd2c', payload, qos=qos)
+            return -1
         try:
-            self.mqtt_client.publish(f'{self.prefix}m/d/{self.device_id}/d2c'.encode(), json.dumps(msg).encode())
+            self.mqtt_client.publish(self.d2c_topic, payload, qos=qos)
         except:
             print("Sending data to nRF Cloud failed")
+            if queue:
+                queue.put(b'd2c', payload, qos=qos)
             self.disconnect()
             return -1
         return 0
 
+    # Send the messages of a burst (e.g. one reporting cycle) in one socket write:
+    #
+    #   with cloud.batch():
+    #       cloud.d2c(msg1)
+    #       cloud.d2c(msg2)
+    def batch(self):
+        return _CloudBatch(self)
+
+    # Add a message to the bulk upload. It gets a timestamp ("ts", ms since the
+    # Unix epoch) so that it keeps the time it was produced at, if the clock
+    # is set. The upload is sent when it reaches bulk_max_msgs messages or
+    # bulk_max_bytes bytes, when its first message is bulk_max_age seconds old
+    # (checked in process()), on disconnect() and with flush_bulk().
+    # Messages always use JSON, a CBOR codec registered for the appId is not used.
+    def bulk(self, msg: dict) -> None:
+        if 'ts' not in msg:
+            now = time.time() + _EPOCH_OFFSET
+            if now > 1577836800:    # The clock has been set (after 2020)
+                msg['ts'] = int(now * 1000)
+        codec = self.codecs.get(msg.get('appId'))
+        if not isinstance(codec, JSONCodec):
+            codec = self.default_codec
+        payload = codec.encode(msg)
+        if self._bulk and self._bulk_len + len(payload) + 1 > self.bulk_max_bytes:
+            self.flush_bulk()
+        if not self._bulk:
+            self._bulk_t = time.ticks_ms()
+        self._bulk.append(payload)
+        self._bulk_len += len(payload) + 1
+        if len(self._bulk) >= self.bulk_max_msgs or self._bulk_len >= self.bulk_max_bytes:
+            self.flush_bulk()
+
+    # Send the bulk upload now. If that isn't possible it goes to the queue, if
+    # there is one, and is lost otherwise.
+    def flush_bulk(self) -> int:
+        if not self._bulk:
+            return 0
+        payload = b'[' + b','.join(self._bulk) + b']'
+        self._bulk = []
+        self._bulk_len = 0
+        if self.compressor:
+            payload = self.compressor.encode(payload)
+        s = self.sizes.get('bulk')
+        if s is None:
+            s = self.sizes['bulk'] = [0, 0, 0]
+        s[0] += 1
+        s[1] += len(payload)
+        s[2] = len(payload)
+        if self.isconnected():
+            try:
+                self.mqtt_client.publish(self.bulk_topic, payload, qos=self.bulk_qos)
+                return 0
+            except:
+                print("Sending bulk data to nRF Cloud failed")
+        if self.queue:
+            self.queue.put(b'd2c/bulk', payload, qos=self.bulk_qos)
+        return -1
+
+    # Encode a message for d2c() with the codec of its appId. The compressor
+    # only takes JSON: its table uses bytes that are also part of CBOR.
+    def encode(self, msg: dict) -> bytes:
+        app = msg.get('appId')
+        if app in _SERVICE_APPS:
+            payload = json.dumps(msg).encode()
+        else:
+            codec = self.codecs.get(app, self.default_codec)
+            payload = codec.encode(msg)
+            if self.compressor and isinstance(codec, JSONCodec):
+                payload = self.compressor.encode(payload)
+        s = self.sizes.get(app)
+        if s is None:
+            s = self.sizes[app] = [0, 0, 0]
+        s[0] += 1
+        s[1] += len(payload)
+        s[2] = len(payload)
+        return payload
+
+    # Queued messages are stored with the topic relative to the prefix, which
+    # may not be known yet when they are queued
+    def _publish_queued(self, topic, msg, retain, qos):
+        if topic == b'd2c':
+            topic = self.d2c_topic
+        elif topic == b'd2c/bulk':
+            topic = self.bulk_topic
+        self.mqtt_client.publish(topic, msg, retain, qos)
+
+    def _drain_queue(self) -> int:
+        if self.queue:
+            try:
+                while self.queue.drain(self._publish_queued, _QUEUE_BATCH):
+                    pass
+            except:
+                print("Sending queued data to nRF Cloud failed")
+                self.disconnect()
+                return -1
+        return 0
+
     def get_shadow(self):
         try:
-            self.mqtt_client.publish(f'$aws/things/{self.device_id}/shadow/get'.encode(), b'')
+            self.mqtt_client.publish(self.shadow_get_topic, b'')
         except:
             print("Getting shadow failed")
             self.disconnect()
 
     def agnss_request(self, types: list) -> None:
+        if self.agnss_cache:
+            data, types = self.agnss_cache.lookup(types)
+            if data:
+                self.nic.agnss_data(data)
+        if self.pgps and 2 in types:
+            eph = self.pgps.lookup()
+            if eph:
+                self.nic.agnss_data(eph)
+                types = [t for t in types if t != 2]
+            if self.pgps.remaining() < self.pgps_min_left:
+                self.pgps_request()
+        if not types:
+            return
         mccmnc = self.nic.status("mccmnc")
         msg = {'appId': 'AGNSS', 'messageType': 'DATA', 'data': {
             'mcc': int(mccmnc[:3]),
@@ -109,12 +916,26 @@ class nRFCloudMQTT:
             'eci': int(self.nic.status("cellid"), 16),
             'rsrp': self.nic.status("rsrp"),
             'types': types,
-            # Change this if you want all the AGSS data
+            # Change this if you want all the AGSS data. Unfiltered responses are
+            # larger than _AGNSS_BUF_SIZE, raise it to keep them off the heap
             'filtered': True,
             'mask': 5
         }}
         self.d2c(msg)
 
+    # Ask nRF Cloud for new P-GPS predictions, starting now. The response says
+    # where to download them from, which process() does.
+    def pgps_request(self) -> None:
+        if self._pgps_pending:
+            return
+        data = {'predictionCount': self.pgps.count, 'predictionIntervalMinutes': self.pgps.period}
+        now = _gps_time()
+        if now is not None:
+            data['startGpsDay'] = now // 86400
+            data['startGpsTimeOfDaySeconds'] = now % 86400
+        if self.d2c({'appId': 'PGPS', 'messageType': 'DATA', 'data': data}) == 0:
+            self._pgps_pending = True
+
     def ground_fix(self, cell, ncells):
         msg = {'appId': 'GROUND_FIX', 'messageType': 'DATA', 'data': {}, 'config': {
             'doReply': True,       # Set to False to not receive a response with location. Location is still saved in nRF Cloud
@@ -149,7 +970,15 @@ class nRFCloudMQTT:
                     'rsqr': ncell[3]
                 })
 
-        self.d2c(msg)
+        if self.fix_cache and msg['config']['doReply']:
+            fix = self.fix_cache.get(msg['data']['lte'][0])
+            if fix:
+                self.nic.location_cloud_fix(*fix)
+                return
+            self._fix_cell = msg['data']['lte'][0]
+        if self.d2c(msg) != 0:
+            self._fix_cell = None
+            return
         if not msg['config']['doReply']:
             # We're not going to get a response from the Cloud, so let's tell the Location system that
             # we were successful to avoid a timeout
@@ -158,10 +987,91 @@ class nRFCloudMQTT:
     def isconnected(self) -> bool:
         return True if self.status >= self.State["PAIRED"] else False
     
+    # Pass _IRQ_RRC_UPDATE and _IRQ_EDRX_UPDATE on to the keepalive scheduler
+    def rrc_update(self, connected: bool) -> None:
+        self.mqtt_client.rrc_update(connected)
+
+    def set_edrx(self, cycle: float) -> None:
+        self.mqtt_client.set_edrx(cycle)
+
+    # Milliseconds until process() has to be called to keep the connection alive
+    # or to send the bulk upload
+    def next_wakeup(self, limit: int = 3600000) -> int:
+        if not self.isconnected():
+            return limit
+        now = time.ticks_ms()
+        if self._bulk:
+            limit = min(limit, max(0, self.bulk_max_age * 1000 - time.ticks_diff(now, self._bulk_t)))
+        t = self.mqtt_client.next_deadline()
+        if t is None:
+            return limit
+        return max(0, min(limit, time.ticks_diff(t, now)))
+
+    # Send the MQTT client statistics (see MQTTClient.stats) in a DEVICE message.
+    # extra is merged in, e.g. the reconnection statistics of mqtt_reconnect.Supervisor.
+    def publish_stats(self, extra: dict = None) -> int:
+        stats = self.mqtt_client.stats()
+        stats['payload_sizes'] = self.sizes
+        if self.fix_cache:
+            stats['ground_fix_cache'] = self.fix_cache.stats()
+        if self.agnss_cache:
+            stats['agnss_cache'] = self.agnss_cache.stats()
+        if self.pgps:
+            stats['pgps'] = self.pgps.stats()
+        if extra:
+            stats.update(extra)
+        self._stats_at = time.ticks_ms()
+        return self.d2c({'appId': 'DEVICE', 'messageType': 'DATA', 'data': {'mqttStats': stats}})
+
     def process(self) -> None:
         if self.isconnected():
+            if self.stats_interval and time.ticks_diff(time.ticks_ms(), self._stats_at) >= self.stats_interval * 1000:
+                self.publish_stats(self.extra_stats() if self.extra_stats else None)
+            if self._bulk and time.ticks_diff(time.ticks_ms(), self._bulk_t) >= self.bulk_max_age * 1000:
+                self.flush_bulk()
             try:
+                if self._resubscribe:
+                    self._resubscribe = False
+                    self._subscribe_topics()
+                if self._revalidate:
+                    # Check the cached prefix, the answer is handled by _on_shadow().
+                    # connect() subscribed to it, or the session has it.
+                    self._revalidate = False
+                    self.mqtt_client.publish(self.shadow_get_topic, b'')
                 self.mqtt_client.process()
             except:
                 print("Connection error, disconnecting")
-                self.disconnect()
\ No newline at end of file
+                self.disconnect()
+            if self.mqtt_client.rx_dropped != self._rx_dropped:
+                # An A-GNSS response there was no memory for, or a message on a
+                # topic of an old prefix that a persistent session still has
+                print(f'{self.mqtt_client.rx_dropped - self._rx_dropped} received message(s) dropped')
+                self._rx_dropped = self.mqtt_client.rx_dropped
+            if self._pgps_url:
+                host, path = self._pgps_url
+                self._pgps_url = None
+                try:
+                    self.pgps.download(host, path)
+                except Exception as e:
+                    print("P-GPS download failed:", e)
+                self._pgps_pending = False
+
+
+# The packets of the batch are sent on exit, so errors show up there rather
+# than in d2c(). They are handled the same way: the connection is closed and
+# QoS 1 messages not acknowledged are sent again after reconnecting.
+class _CloudBatch:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def __enter__(self):
+        self._cloud.mqtt_client.batch().__enter__()
+        return self._cloud
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._cloud.mqtt_client.batch().__exit__(exc_type, exc, tb)
+        except:
+            print("Sending data to nRF Cloud failed")
+            self._cloud.disconnect()
+        return False
@@ -0,0 +1,274 @@
+# Encoding and compression of uplink payloads.
+#
+# JSONCodec and CBORCodec turn a message (dict) into a payload. Both can write
+# floats in fixed point with a number of decimals per key, instead of at full
+# precision. JSON stays readable by nRF Cloud; CBOR is smaller but only for
+# backends that decode it.
+#
+# DeflateCodec compresses JSON payloads (not CBOR, see below). nRF Cloud
+# stores d2c payloads as they are, so only enable it where your backend
+# decodes them.
+
+import io
+import json
+import ustruct as struct
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+    try:
+        import zlib     # CPython, for the host tools
+    except ImportError:
+        zlib = None
+
+_MAGIC = 0x00
+
+# Decimals kept for the values of the tracker's messages: about 0.1 m for
+# coordinates, and the resolution of the sensors. "data" is the value of
+# scalar messages such as TEMP and HUMID.
+TRACKER_PRECISION = {
+    'lat': 6, 'lng': 6, 'acc': 1, 'alt': 1, 'hdg': 1, 'spd': 2, 'data': 2,
+}
+
+
+def _fixed(fmt, v):
+    s = fmt % v
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+    return s
+
+
+# Compact JSON: no spaces after separators, and floats of the keys in
+# precision written with that many decimals. Without precision and with
+# compact=False this is json.dumps().
+class JSONCodec:
+    def __init__(self, precision=None, compact=True):
+        self.precision = precision or {}
+        self.compact = compact
+        self._fmt = {}
+        for k, d in self.precision.items():
+            self._fmt[k] = '%%.%df' % d
+
+    def encode(self, msg):
+        if not self.precision and not self.compact:
+            return json.dumps(msg).encode()
+        out = []
+        self._enc(out, msg, None)
+        return ''.join(out).encode()
+
+    def _enc(self, out, v, key):
+        if isinstance(v, dict):
+            out.append('{')
+            first = True
+            for k, x in v.items():
+                if not first:
+                    out.append(',' if self.compact else ', ')
+                first = False
+                out.append(json.dumps(k))
+                out.append(':' if self.compact else ': ')
+                self._enc(out, x, k)
+            out.append('}')
+        elif isinstance(v, (list, tuple)):
+            out.append('[')
+            for i, x in enumerate(v):
+                if i:
+                    out.append(',' if self.compact else ', ')
+                self._enc(out, x, key)
+            out.append(']')
+        elif isinstance(v, float) and key in self._fmt:
+            out.append(_fixed(self._fmt[key], v))
+        else:
+            out.append(json.dumps(v))
+
+
+# CBOR (RFC 8949). Floats are sent as 32-bit floats when that keeps the
+# decimals given in precision for their key (or when there are none), and
+# otherwise as a decimal fraction (tag 4: exponent and integer mantissa),
+# e.g. a latitude with 6 decimals in 8 bytes instead of 9 for a 64-bit float.
+class CBORCodec:
+    def __init__(self, precision=None):
+        self.precision = precision or {}
+
+    def encode(self, msg):
+        out = bytearray()
+        self._enc(out, msg, None)
+        return bytes(out)
+
+    def _head(self, out, major, n):
+        if n < 24:
+            out.append(major << 5 | n)
+        elif n < 0x100:
+            out.append(major << 5 | 24)
+            out.append(n)
+        elif n < 0x10000:
+            out.append(major << 5 | 25)
+            out.extend(struct.pack('>H', n))
+        elif n < 0x100000000:
+            out.append(major << 5 | 26)
+            out.extend(struct.pack('>I', n))
+        else:
+            out.append(major << 5 | 27)
+            out.extend(struct.pack('>Q', n))
+
+    def _enc(self, out, v, key):
+        if v is None:
+            out.append(0xF6)
+        elif v is True:
+            out.append(0xF5)
+        elif v is False:
+            out.append(0xF4)
+        elif isinstance(v, int):
+            if v >= 0:
+                self._head(out, 0, v)
+            else:
+                self._head(out, 1, -1 - v)
+        elif isinstance(v, float):
+            f = struct.pack('>f', v)
+            d = self.precision.get(key)
+            if d is None or abs(struct.unpack('>f', f)[0] - v) < 0.5 * 10 ** -d:
+                out.append(0xFA)
+                out.extend(f)
+            else:
+                out.append(0xC4)
+                out.append(0x82)
+                self._enc(out, -d, None)
+                self._enc(out, round(v * 10 ** d), None)
+        elif isinstance(v, str):
+            b = v.encode()
+            self._head(out, 3, len(b))
+            out.extend(b)
+        elif isinstance(v, (bytes, bytearray)):
+            self._head(out, 2, len(v))
+            out.extend(v)
+        elif isinstance(v, (list, tuple)):
+            self._head(out, 4, len(v))
+            for x in v:
+                self._enc(out, x, key)
+        elif isinstance(v, dict):
+            self._head(out, 5, len(v))
+            for k, x in v.items():
+                self._enc(out, k, None)
+                self._enc(out, x, k)
+        else:
+            raise TypeError(type(v))
+
+
+# Table 1, from the message shapes of the asset tracker and nrfcloud_mqtt.
+# Longer entries first, as they are substituted in this order. At most 31 entries.
+# They match the output of json.dumps() (a space after ':' and ','); compact
+# JSON is matched by the same entries without the spaces (see compact_table()).
+NRFCLOUD_TABLE = (
+    b'"messageType": "DATA"',
+    b'{"appId": "',
+    b'"networkInfo": {',
+    b'"currentBand": ',
+    b'"networkMode": "',
+    b'"ipAddress": "',
+    b'"areaCode": ',
+    b'"mqttStats": {',
+    b'"cellID": ',
+    b'"mccmnc": "',
+    b'"data": {',
+    b'"data": ',
+    b'"extra": ',
+    b'"HUMID"',
+    b'"TEMP"',
+    b'"GNSS"',
+    b'"DEVICE"',
+    b'"BUTTON"',
+    b'"rsrp": ',
+    b'"lat": ',
+    b'"lng": ',
+    b'"acc": ',
+    b'"alt": ',
+    b'"hdg": ',
+    b'"spd": ',
+    b'"ts": ',
+    b'LTE-M"',
+    b'NB-IoT"',
+    b'"tx_',
+    b'"rx_',
+    b'"rtt_',
+)
+
+
+# The entries of table with the separators of compact JSON (JSONCodec())
+def compact_table(table):
+    return tuple(s.replace(b'": ', b'":').replace(b', ', b',') for s in table)
+
+
+# MicroPython's deflate module has no preset dictionary (zdict) support, so the
+# dictionary is applied before deflate: strings that appear in every nRF Cloud
+# message (keys such as "appId", "messageType", "data" and common values) are
+# replaced by single control bytes 0x01-0x1F, which json.dumps() never emits.
+# The result is then raw-deflated with a small window. Binary payloads such as
+# CBOR do contain those bytes, and decode() would turn them into table strings,
+# so they must not be given to encode(). Payloads without spaces after ':' use
+# the compact variant of the table.
+#
+# An encoded payload starts with a 0x00 byte (a JSON document never does),
+# followed by the table id (with bit 7 set for the compact variant) and the raw
+# deflate stream. decode() reverses it.
+class DeflateCodec:
+    # Payloads shorter than threshold bytes are sent as they are: deflate
+    # doesn't save anything on them. wbits is the deflate window (2**wbits bytes).
+    def __init__(self, threshold=96, table=NRFCLOUD_TABLE, table_id=1, wbits=8):
+        assert len(table) < 32 and table_id < 0x80
+        self.threshold = threshold
+        self.table = table
+        self._compact = compact_table(table)
+        self.table_id = table_id
+        self.wbits = wbits
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def available(self):
+        return deflate is not None or zlib is not None
+
+    def _substitute(self, data, table):
+        for i, s in enumerate(table):
+            data = data.replace(s, bytes((i + 1,)))
+        return data
+
+    # Compress a JSON payload. Returns it unchanged if it is under the
+    # threshold or doesn't get smaller.
+    def encode(self, payload):
+        if len(payload) < self.threshold or not self.available():
+            return payload
+        if b'": ' in payload:
+            tid = self.table_id
+            data = self._substitute(payload, self.table)
+        else:
+            tid = self.table_id | 0x80
+            data = self._substitute(payload, self._compact)
+        if deflate:
+            buf = io.BytesIO()
+            buf.write(bytes((_MAGIC, tid)))
+            with deflate.DeflateIO(buf, deflate.RAW, self.wbits) as d:
+                d.write(data)
+            out = buf.getvalue()
+        else:
+            c = zlib.compressobj(9, zlib.DEFLATED, -max(9, self.wbits))
+            out = bytes((_MAGIC, tid)) + c.compress(data) + c.flush()
+        if len(out) >= len(payload):
+            return payload
+        self.bytes_in += len(payload)
+        self.bytes_out += len(out)
+        return out
+
+    # Inverse of encode(). Payloads that are not encoded are returned as they are.
+    def decode(self, data):
+        if not data or data[0] != _MAGIC:
+            return data
+        if data[1] & 0x7F != self.table_id:
+            raise ValueError("Unknown table")
+        table = self._compact if data[1] & 0x80 else self.table
+        if deflate:
+            with deflate.DeflateIO(io.BytesIO(data[2:]), deflate.RAW, self.wbits) as d:
+                raw = d.read()
+        else:
+            raw = zlib.decompress(data[2:], -15)
+        for i in range(len(table) - 1, -1, -1):
+            raw = raw.replace(bytes((i + 1,)), table[i])
+        return raw
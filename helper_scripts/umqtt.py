@@ -2,15 +2,74 @@
 # to use offloaded TLS sockets that are used in Zephyr.
 
 import socket
+import uselect as select
 import ustruct as struct
 from ubinascii import hexlify
 import time
+from array import array
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import uasyncio as asyncio
+    except ImportError:
+        asyncio = None
 
 
 class MQTTException(Exception):
     pass
 
 
+# Upper bounds (ms) of the round-trip time histogram buckets. The last
+# bucket counts everything above 10 s.
+_RTT_EDGES = (50, 100, 200, 500, 1000, 2000, 5000, 10000)
+_RTT_BUCKETS = 9
+
+
+# A topic registered with MQTTClient.topic(). It holds the topic as it goes
+# on the wire (2-byte length followed by the name), so publishing with it
+# skips all per-message formatting and encoding.
+class Topic:
+    def __init__(self, name):
+        if isinstance(name, str):
+            name = name.encode()
+        self.name = name
+        self.wire = struct.pack("!H", len(name)) + name
+        # MQTT 5 topic alias, assigned the first time it is published on a connection
+        self.alias = 0
+
+    def __len__(self):
+        return len(self.name)
+
+
+# Match a topic against a subscription filter with the + and # wildcards.
+# Works on the raw bytes, without splitting or decoding the topic.
+def topic_match(filt, topic):
+    nf = len(filt)
+    nt = len(topic)
+    # Wildcards at the first level don't match topics starting with $
+    if nt and topic[0] == 0x24 and nf and filt[0] in b"+#":
+        return False
+    i = 0
+    j = 0
+    while i < nf:
+        c = filt[i]
+        if c == 0x23:  # '#' matches everything below
+            return True
+        if c == 0x2B:  # '+' matches one level
+            while j < nt and topic[j] != 0x2F:
+                j += 1
+            i += 1
+            continue
+        if j >= nt or topic[j] != c:
+            # "a/#" also matches "a"
+            return j == nt and c == 0x2F and i + 2 == nf and filt[i + 1] == 0x23
+        i += 1
+        j += 1
+    return j == nt
+
+
 class MQTTClient:
     def __init__(
         self,
@@ -22,6 +81,12 @@ class MQTTClient:
         keepalive=0,
         ssl=False,
         ssl_params={},
+        tx_buf_size=256,
+        rx_buf_size=512,
+        max_inflight=0,
+        version=4,
+        session_expiry=3600,
+        batch_buf_size=1024,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -40,29 +105,397 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
-        self.last_ping = 0
+        # Optional callable(server, port) returning the address to connect to,
+        # used instead of a DNS lookup on every connect (see mqtt_reconnect.AddrCache)
+        self.resolver = None
+        # Keepalive, in time.ticks_ms(). Any packet sent restarts the keepalive
+        # period, so PINGREQ only goes out after keepalive seconds of silence,
+        # or earlier when the radio is up anyway (see rrc_update and set_edrx).
+        self.last_tx = time.ticks_ms()
+        self.n_pings = 0
+        self._rrc = False
+        self._edrx_ms = 0
+        self._edrx_ref = 0
+        # Outgoing packets are assembled here so that each one goes out in a
+        # single socket write (every write is a round trip into the modem)
+        self._tx = bytearray(tx_buf_size)
+        self.n_writes = 0
+        self.n_tx_bytes = 0
+        # Writes and bytes used by the last call to publish()
+        self.pub_writes = 0
+        self.pub_bytes = 0
+        # Inside batch(), complete packets are collected here and sent with a
+        # single write. Allocated by the first batch() and kept.
+        self._batch_size = batch_buf_size
+        self._bbuf = None
+        self._bn = 0
+        self._bdepth = 0
+        self._batch = _Batch(self)
+        # Incoming data is read in bulk into this buffer and MQTT packets
+        # are parsed out of it. Data between _rs and _re is not parsed yet.
+        self._rx = bytearray(rx_buf_size)
+        self._rxmv = memoryview(self._rx)
+        self._rs = 0
+        self._re = 0
+        self.n_reads = 0
+        self.n_rx_bytes = 0
+        # Packet id of the last PUBACK/SUBACK and the SUBACK return code(s)
+        self.ack_pid = 0
+        self.suback_rc = 0
+        self.suback_codes = b""
+        self._rx_pid = 0
+        self.rx_topic = None    # Topic of the last PUBLISH received
+        # QoS 1 publishes waiting for their PUBACK. With max_inflight > 0,
+        # publish() returns as soon as the packet is sent and up to
+        # max_inflight messages can be unacknowledged at the same time.
+        # A slot is free when its pid is 0.
+        self.max_inflight = max_inflight
+        self._if_pid = array("H", [0] * max_inflight)
+        self._if_topic = [None] * max_inflight
+        self._if_msg = [None] * max_inflight
+        self._if_retain = bytearray(max_inflight)
+        self.puback_cb = None
+        self._topics = {}
+        # Subscription router: exact topics are looked up in a dict,
+        # filters with wildcards are checked in order
+        self._routes = {}
+        self._wild = []
+        self.rx_dropped = 0
+        self.rx_oversize = 0
+        # MQTT protocol level: 4 (3.1.1) or 5. With 5, registered topics are
+        # replaced by 2-byte aliases after their first publish on a connection,
+        # up to the number of aliases the server accepts (alias_max).
+        assert version in (4, 5)
+        self.version = version
+        self.session_expiry = session_expiry
+        self.alias_max = 0
+        self._next_alias = 1
+        self.alias_saved = 0    # Bytes saved by topic aliases on this connection
+        self.ack_rc = 0         # Reason code of the last PUBACK (MQTT 5)
+        # Statistics, see stats(). Counters are plain ints and round-trip
+        # times go into preallocated histograms, so recording never allocates.
+        # Send times are kept per packet id in a small ring (pid & 7); a
+        # sample is lost if 8 or more requests are outstanding.
+        self.n_tx_pkts = 0
+        self.n_rx_pkts = 0
+        self.n_rx_msgs = 0
+        self.n_connects = 0
+        self.rtt_puback = array("I", [0] * _RTT_BUCKETS)
+        self.rtt_suback = array("I", [0] * _RTT_BUCKETS)
+        self.rtt_ping = array("I", [0] * _RTT_BUCKETS)
+        self._rtt_pid = array("H", [0] * 8)
+        self._rtt_t = array("I", [0] * 8)
+        self._ping_t = -1
 
     def __del__(self):
         if self.sock:
             self.sock.close()
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    def _write(self, buf, n=-1):
+        if self._bdepth:
+            m = len(buf) if n < 0 else n
+            if self._bn + m > len(self._bbuf):
+                self._flush()
+            if m <= len(self._bbuf):
+                self._bbuf[self._bn : self._bn + m] = buf if m == len(buf) else memoryview(buf)[:m]
+                self._bn += m
+                return
+        self._sock_write(buf, n)
 
-    def _recv_len(self):
+    def _sock_write(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+            self.sock.write(buf)
+        else:
+            self.sock.write(buf, n)
+        self.n_writes += 1
+        self.n_tx_bytes += n
+        self.last_tx = time.ticks_ms()
+
+    # Send the packets collected by batch()
+    def _flush(self):
+        if self._bn:
+            n = self._bn
+            self._bn = 0
+            self._sock_write(self._bbuf, n)
+
+    # Context manager that collects the packets sent inside it and sends
+    # them with one socket write when it exits, so that a burst of small
+    # publishes goes out in as few TLS records as possible:
+    #
+    #   with client.batch():
+    #       client.publish(t1, m1)
+    #       client.publish(t2, m2, qos=1)
+    #
+    # The batch is sent early when the buffer is full, or before anything
+    # is read from the socket (e.g. a blocking QoS 1 publish waiting for its
+    # PUBACK). Packets larger than the buffer go out on their own.
+    def batch(self):
+        if self._bbuf is None:
+            self._bbuf = bytearray(self._batch_size)
+        return self._batch
+
+    # Put the fixed header (packet type and remaining length) at the start
+    # of the tx buffer. Returns the offset where the variable header starts.
+    def _put_header(self, op, sz):
+        self.n_tx_pkts += 1
+        buf = self._tx
+        buf[0] = op
+        i = 1
+        while sz > 0x7F:
+            buf[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
+
+    # Read the variable byte integer at offset p of the rx buffer.
+    # Returns the value; self._vp is left on the next byte.
+    def _varint(self, p):
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = self._rx[p]
+            p += 1
             n |= (b & 0x7F) << sh
             if not b & 0x80:
+                self._vp = p
                 return n
             sh += 7
 
+    # Put a topic name or a registered Topic in the tx buffer at offset i
+    def _put_topic(self, i, topic):
+        if isinstance(topic, Topic):
+            n = len(topic.wire)
+            self._tx[i : i + n] = topic.wire
+            return i + n
+        return self._put_str(i, topic)
+
+    # Put a length-prefixed string in the tx buffer at offset i
+    def _put_str(self, i, s):
+        if isinstance(s, str):
+            s = s.encode()
+        buf = self._tx
+        n = len(s)
+        buf[i] = n >> 8
+        buf[i + 1] = n & 0xFF
+        buf[i + 2 : i + 2 + n] = s
+        return i + 2 + n
+
+    # Read whatever the socket has into the free part of the rx buffer.
+    # Returns None if the socket is non-blocking and there is no data.
+    def _fill(self):
+        if self._bn:
+            self._flush()
+        if self._rs == self._re:
+            self._rs = self._re = 0
+        elif self._re == len(self._rx):
+            self._compact()
+        n = self.sock.readinto(self._rxmv[self._re :])
+        if n is None:
+            return None
+        if n == 0:
+            raise OSError(-1)
+        self.n_reads += 1
+        self.n_rx_bytes += n
+        self._re += n
+        return n
+
+    def _compact(self):
+        n = self._re - self._rs
+        self._rx[:n] = self._rx[self._rs : self._re]
+        self._rs = 0
+        self._re = n
+
+    # Block until there are at least n unparsed bytes in the rx buffer
+    def _need(self, n):
+        assert n <= len(self._rx)
+        if self._rs + n > len(self._rx):
+            self._compact()
+        while self._re - self._rs < n:
+            self._fill()
+
+    # Read n bytes into mv, first from the rx buffer, then straight from the socket
+    def _read_into(self, mv, n):
+        k = min(n, self._re - self._rs)
+        mv[:k] = self._rxmv[self._rs : self._rs + k]
+        self._rs += k
+        while k < n:
+            r = self.sock.readinto(mv[k:n])
+            if not r:
+                raise OSError(-1)
+            self.n_reads += 1
+            self.n_rx_bytes += r
+            k += r
+
+    # Discard the next n bytes of the stream
+    def _skip(self, n):
+        while 1:
+            k = min(n, self._re - self._rs)
+            self._rs += k
+            n -= k
+            if not n:
+                return
+            self._fill()
+
+    # Decode the fixed header at the start of the rx buffer.
+    # Returns the remaining length and the size of the fixed header.
+    def _recv_len(self):
+        n = 0
+        sh = 0
+        i = 1
+        while 1:
+            self._need(i + 1)
+            b = self._rx[self._rs + i]
+            i += 1
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n, i
+            sh += 7
+
     def set_callback(self, f):
         self.cb = f
 
+    # Deliver messages whose topic matches filt to handler(topic, msg) instead
+    # of the callback. filt can be a name, a Topic, or a filter with + and #.
+    # Messages that match no route still go to the callback, or are discarded
+    # and counted in rx_dropped if there is none.
+    #
+    # Large payloads don't have to be allocated for each message:
+    #  - buf: a preallocated bytearray the payload is read into. The handler
+    #    gets a memoryview over the received part. A payload that doesn't fit
+    #    is read into a buffer allocated for it (counted in rx_oversize), or
+    #    discarded and counted in rx_dropped if there is not enough memory.
+    #  - stream=True: the payload is not stored at all, the handler is called
+    #    as handler(topic, chunk, offset, total) for each chunk as it arrives.
+    # In both cases the memoryview is only valid during the call.
+    def add_route(self, filt, handler, buf=None, stream=False):
+        filt = self._filter(filt)
+        r = (handler, buf, stream)
+        if b"+" in filt or b"#" in filt:
+            self.remove_route(filt)
+            self._wild.append((filt, r))
+        else:
+            self._routes[filt] = r
+
+    def remove_route(self, filt):
+        filt = self._filter(filt)
+        self._routes.pop(filt, None)
+        for r in self._wild:
+            if r[0] == filt:
+                self._wild.remove(r)
+                return
+
+    def _filter(self, filt):
+        if isinstance(filt, Topic):
+            return filt.name
+        if isinstance(filt, str):
+            return filt.encode()
+        return filt
+
+    # Route for an incoming topic: (handler, buf, stream), None if there is none
+    def _route(self, topic):
+        r = self._routes.get(topic)
+        if r is None:
+            for f, fr in self._wild:
+                if topic_match(f, topic):
+                    return fr
+        return r
+
+    # Register a topic once and get a handle that can be used instead of the
+    # topic name in publish() and subscribe(). Registering the same name again
+    # returns the same handle.
+    def topic(self, name):
+        if isinstance(name, str):
+            name = name.encode()
+        t = self._topics.get(name)
+        if t is None:
+            t = self._topics[name] = Topic(name)
+        return t
+
+    # Called with the packet id of each windowed QoS 1 publish once it is acknowledged
+    def set_puback_callback(self, f):
+        self.puback_cb = f
+
+    def _next_pid(self):
+        while 1:
+            self.pid = self.pid % 65535 + 1
+            if self.pid not in self._if_pid:
+                return self.pid
+
+    # Number of QoS 1 messages still waiting for their PUBACK
+    def pending(self):
+        n = 0
+        for pid in self._if_pid:
+            if pid:
+                n += 1
+        return n
+
+    def is_pending(self, pid):
+        return pid != 0 and pid in self._if_pid
+
+    # Block until all in-flight QoS 1 messages have been acknowledged
+    def wait_acks(self):
+        while self.pending():
+            self.wait_msg()
+
+    def _puback(self, pid):
+        for i in range(self.max_inflight):
+            if self._if_pid[i] == pid:
+                self._if_pid[i] = 0
+                self._if_topic[i] = None
+                self._if_msg[i] = None
+                if self.puback_cb:
+                    self.puback_cb(pid)
+                return
+
+    # Remember when the request with packet id pid was sent
+    def _rtt_start(self, pid):
+        self._rtt_pid[pid & 7] = pid
+        self._rtt_t[pid & 7] = time.ticks_ms()
+
+    # Record the round-trip time of pid in hist, if its send time is known
+    def _rtt_end(self, hist, pid):
+        if self._rtt_pid[pid & 7] == pid:
+            self._rtt_pid[pid & 7] = 0
+            self._rtt_add(hist, time.ticks_diff(time.ticks_ms(), self._rtt_t[pid & 7]))
+
+    def _rtt_add(self, hist, ms):
+        b = 0
+        while b < _RTT_BUCKETS - 1 and ms > _RTT_EDGES[b]:
+            b += 1
+        hist[b] += 1
+
+    # Counters and round-trip time histograms (counts per bucket, see rtt_edges)
+    def stats(self):
+        return {
+            "connects": self.n_connects,
+            "tx_pkts": self.n_tx_pkts,
+            "tx_bytes": self.n_tx_bytes,
+            "writes": self.n_writes,
+            "rx_pkts": self.n_rx_pkts,
+            "rx_msgs": self.n_rx_msgs,
+            "rx_bytes": self.n_rx_bytes,
+            "reads": self.n_reads,
+            "rx_dropped": self.rx_dropped,
+            "rx_oversize": self.rx_oversize,
+            "pings": self.n_pings,
+            "inflight": self.pending(),
+            "alias_saved": self.alias_saved,
+            "rtt_edges": _RTT_EDGES,
+            "rtt_puback": list(self.rtt_puback),
+            "rtt_suback": list(self.rtt_suback),
+            "rtt_ping": list(self.rtt_ping),
+        }
+
+    def reset_stats(self):
+        self.n_tx_pkts = self.n_tx_bytes = self.n_writes = 0
+        self.n_rx_pkts = self.n_rx_msgs = self.n_rx_bytes = self.n_reads = 0
+        self.n_connects = self.n_pings = self.rx_dropped = self.rx_oversize = 0
+        for h in (self.rtt_puback, self.rtt_suback, self.rtt_ping):
+            for b in range(_RTT_BUCKETS):
+                h[b] = 0
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
         assert topic
@@ -71,11 +504,15 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def connect(self, clean_session=True):
+    # Resolve the server and open the (offloaded TLS) socket
+    def _open(self):
         try:
-            addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+            if self.resolver:
+                addr = self.resolver(self.server, self.port)
+            else:
+                addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         except:
-            return -1
+            return False
         # Create offloaded TLS socket
         if self.ssl:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TLS_1_2)
@@ -83,164 +520,526 @@ class MQTTClient:
                 self.sock.tlswrap(self.ssl_params['sec_tag'], verify=self.ssl_params.get('verify', socket.TLS_PEER_VERIFY_REQUIRED), hostname=self.ssl_params['hostname'])
             else:
                 self.sock.tlswrap(self.ssl_params['sec_tag'], verify=self.ssl_params.get('verify', socket.TLS_PEER_VERIFY_REQUIRED))
+            # Let the modem resume the previous TLS session (abbreviated handshake)
+            # if the socket module exposes the option
+            if self.ssl_params.get('session_cache', True) and hasattr(socket, 'TLS_SESSION_CACHE'):
+                try:
+                    self.sock.setsockopt(socket.SOL_TLS, socket.TLS_SESSION_CACHE, 1)
+                except:
+                    pass
         else:
             self.sock = socket.socket()
-        
+
         try:
             self.sock.connect(addr)
         except:
             self.sock.close()
-            return -1
-
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            return False
+        self._rs = self._re = 0
+        return True
 
+    # Assemble the CONNECT packet in the tx buffer. Returns its length.
+    def _connect_pkt(self, clean_session):
+        v5 = self.version == 5
         sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
+        flags = clean_session << 1
+        # MQTT 5: the session only outlives the connection with a Session Expiry Interval
+        expiry = v5 and not clean_session and self.session_expiry
+        if v5:
+            sz += 6 if expiry else 1
         if self.user is not None:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
+            flags |= 0xC0
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
         if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
+            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg) + v5
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+        assert sz + 5 <= len(self._tx), "CONNECT does not fit in tx buffer"
 
-        i = 1
-        while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
+        i = self._put_header(0x10, sz)
+        i = self._put_str(i, b"MQTT")
+        struct.pack_into("!BBH", self._tx, i, self.version, flags, self.keepalive)
+        i += 4
+        if expiry:
+            struct.pack_into("!BBI", self._tx, i, 5, 0x11, expiry)
+            i += 6
+        elif v5:
+            self._tx[i] = 0
             i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        self._send_str(self.client_id)
+        i = self._put_str(i, self.client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            if v5:
+                self._tx[i] = 0     # No will properties
+                i += 1
+            i = self._put_str(i, self.lw_topic)
+            i = self._put_str(i, self.lw_msg)
         if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
+            i = self._put_str(i, self.user)
+            i = self._put_str(i, self.pswd)
+        return i
+
+    # Check the CONNACK at the start of the rx buffer (its first two bytes
+    # must be there). Returns the session present flag, or -1 if the packet
+    # is not a CONNACK.
+    def _connack(self):
+        resp = self._rx
+        if resp[0] != 0x20 or resp[1] & 0x80 or resp[1] < 2:
+            return -1
+        self._rs = 2 + resp[1]
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        self.alias_max = 0
+        self._next_alias = 1
+        self.alias_saved = 0
+        for t in self._topics.values():
+            t.alias = 0
+        if self.version == 5:
+            self._connack_props()
+        self.n_connects += 1
+        self.n_rx_pkts += 1
+        return resp[2] & 1
 
+    # MQTT 5 CONNACK properties. Only Topic Alias Maximum is used, the rest are skipped.
+    def _connack_props(self):
+        end = self._varint(4)
+        end += self._vp
+        p = self._vp
+        while p < end:
+            prop = self._rx[p]
+            p += 1
+            if prop == 0x22:    # Topic Alias Maximum
+                self.alias_max = self._rx[p] << 8 | self._rx[p + 1]
+            if prop in (0x13, 0x21, 0x22):
+                p += 2
+            elif prop in (0x11, 0x27):
+                p += 4
+            elif prop in (0x12, 0x1A, 0x1C, 0x1F):
+                p += 2 + (self._rx[p] << 8 | self._rx[p + 1])
+            elif prop == 0x26:  # User property: two strings
+                p += 2 + (self._rx[p] << 8 | self._rx[p + 1])
+                p += 2 + (self._rx[p] << 8 | self._rx[p + 1])
+            else:               # Byte properties
+                p += 1
+
+    def connect(self, clean_session=True):
+        if not self._open():
+            return -1
+        self._write(self._tx, self._connect_pkt(clean_session))
         try:
-            resp = self.sock.read(4)
+            self._need(2)
+            self._need(2 + self._rx[1])
         except:
             self.sock.close()
             return -1
-
-        if resp[0] != 0x20 or resp[1] != 0x02:
+        ret = self._connack()
+        if ret < 0:
             self.sock.close()
             return -1
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        
-        self.last_ping = time.time()
-        return resp[2] & 1
+        self._resend_inflight()
+        return ret
 
     def disconnect(self):
         # If the server closed the connection, we still need to close our side, so ignore
         # the exception when trying to write into a half-open socket. 
         try:
-            self.sock.write(b"\xe0\0")
+            self._write(b"\xe0\0")
+            self.n_tx_pkts += 1
+            self._flush()
         except:
             pass
+        self._bn = 0
         self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
-        self.last_ping = time.time()
+        self._write(b"\xc0\0")
+        self.n_pings += 1
+        self.n_tx_pkts += 1
+        self._ping_t = time.ticks_ms()
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+    # Call from the _IRQ_RRC_UPDATE handler with the RRC mode (True: connected,
+    # False: idle). While the radio is connected, a ping that is due within half
+    # the keepalive goes out with the next process() instead of waking it up later.
+    def rrc_update(self, connected):
+        self._rrc = bool(connected)
+        if not connected:
+            # The eDRX cycle starts over when the radio goes idle
+            self._edrx_ref = time.ticks_ms()
+
+    # eDRX cycle in seconds, as reported by _IRQ_EDRX_UPDATE (0 when eDRX is off).
+    # Pings are then moved to the last paging window before they are due.
+    def set_edrx(self, cycle):
+        self._edrx_ms = int(cycle * 1000)
+        self._edrx_ref = time.ticks_ms()
+
+    # Tick (time.ticks_ms) by which process() has to be called to keep the
+    # connection alive, or None if keepalive is off.
+    def next_deadline(self):
+        if not self.keepalive:
+            return None
+        k = self.keepalive * 1000
+        due = time.ticks_add(self.last_tx, k)
+        c = self._edrx_ms
+        if c and c <= k // 2:
+            # Keep the reference close, ticks_diff() only works over half the tick period
+            n = time.ticks_diff(self.last_tx, self._edrx_ref) // c
+            if n > 0:
+                self._edrx_ref = time.ticks_add(self._edrx_ref, n * c)
+            n = time.ticks_diff(due, self._edrx_ref) // c
+            at = time.ticks_add(self._edrx_ref, n * c)
+            if time.ticks_diff(at, self.last_tx) >= k // 2:
+                return at
+        return due
+
+    def _ping_due(self):
+        if not self.keepalive:
+            return False
+        now = time.ticks_ms()
+        if self._rrc and time.ticks_diff(now, self.last_tx) >= self.keepalive * 500:
+            return True
+        return time.ticks_diff(now, self.next_deadline()) >= 0
+
+    # Put the headers of a PUBLISH with a payload of length bytes in the tx
+    # buffer. Returns where the payload starts.
+    def _put_publish(self, topic, length, retain, qos, pid, dup):
+        buf = self._tx
+        alias = 0
+        tl = len(topic)
+        if self.version == 5 and self.alias_max and isinstance(topic, Topic):
+            if topic.alias:
+                alias = topic.alias
+                tl = 0
+                self.alias_saved += len(topic) - 3
+            elif self._next_alias <= self.alias_max:
+                alias = topic.alias = self._next_alias
+                self._next_alias += 1
+                self.alias_saved -= 3
+        sz = 2 + tl + length
         if qos > 0:
             sz += 2
+        if self.version == 5:
+            sz += 4 if alias else 1
         assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
+        assert tl + 13 <= len(buf), "Topic does not fit in tx buffer"
+        i = self._put_header(0x30 | dup << 3 | qos << 1 | retain, sz)
+        if tl:
+            i = self._put_topic(i, topic)
+        else:
+            buf[i] = buf[i + 1] = 0
+            i += 2
+        if qos > 0:
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        if alias:
+            struct.pack_into("!BBH", buf, i, 3, 0x23, alias)
+            i += 4
+        elif self.version == 5:
+            buf[i] = 0
             i += 1
-        pkt[i] = sz
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        return i
+
+    def _send_publish(self, topic, msg, retain, qos, pid, dup=False):
+        i = self._put_publish(topic, len(msg), retain, qos, pid, dup)
+        if i + len(msg) <= len(self._tx):
+            # The whole packet fits: send it with a single write
+            self._tx[i : i + len(msg)] = msg
+            self._write(self._tx, i + len(msg))
+        else:
+            # Large payloads are sent as is, after the headers
+            self._write(self._tx, i)
+            self._write(msg)
+        if pid:
+            self._rtt_start(pid)
+
+    # With a QoS 1 window (max_inflight > 0) this returns the packet id
+    # without waiting for the PUBACK. It only blocks while the window is full.
+    def publish(self, topic, msg, retain=False, qos=0):
+        pid = 0
+        if qos == 1 and self.max_inflight:
+            while self.pending() == self.max_inflight:
+                self.wait_msg()
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        self.last_ping = time.time()
+            pid = self._next_pid()
+        w = self.n_writes
+        b = self.n_tx_bytes
+        self._send_publish(topic, msg, retain, qos, pid)
+        self.pub_writes = self.n_writes - w
+        self.pub_bytes = self.n_tx_bytes - b
         if qos == 1:
+            if self.max_inflight:
+                i = 0
+                while self._if_pid[i]:
+                    i += 1
+                self._if_pid[i] = pid
+                self._if_topic[i] = topic
+                self._if_msg[i] = msg
+                self._if_retain[i] = retain
+                return pid
             while 1:
                 op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
+                if op == 0x40 and self.ack_pid == pid:
+                    return
         elif qos == 2:
             assert 0
 
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        self.last_ping = time.time()
+    # Publish a message of a known total length whose payload comes from source:
+    # an object with readinto() (e.g. a file), or an iterable/generator of bytes-like
+    # chunks. The payload goes out in tx buffer sized chunks, so it never has to be
+    # in RAM as a whole. With qos=1 this waits for the PUBACK; streamed messages
+    # can't be sent again after a reconnect.
+    def publish_stream(self, topic, length, source, retain=False, qos=0):
+        assert qos < 2
+        buf = self._tx
+        mv = memoryview(buf)
+        pid = self._next_pid() if qos > 0 else 0
+        i = self._put_publish(topic, length, retain, qos, pid, False)
+        left = length
+        if hasattr(source, "readinto"):
+            while left:
+                n = source.readinto(mv[i : i + min(left, len(buf) - i)])
+                if not n:
+                    break
+                i += n
+                left -= n
+                if i == len(buf):
+                    self._write(buf, i)
+                    i = 0
+        else:
+            for chunk in source:
+                k = 0
+                while k < len(chunk) and left:
+                    n = min(len(chunk) - k, len(buf) - i, left)
+                    buf[i : i + n] = chunk[k : k + n]
+                    i += n
+                    k += n
+                    left -= n
+                    if i == len(buf):
+                        self._write(buf, i)
+                        i = 0
+                if not left:
+                    break
+        if i:
+            self._write(buf, i)
+        if left:
+            # The broker is still waiting for the rest of the packet
+            raise MQTTException("Stream shorter than length")
+        if qos == 1:
+            self._rtt_start(pid)
+            while 1:
+                op = self.wait_msg()
+                if op == 0x40 and self.ack_pid == pid:
+                    return
+
+    # Send again, with the DUP flag, the messages that were not acknowledged
+    # before the connection was lost
+    def _resend_inflight(self):
+        for i in range(self.max_inflight):
+            if self._if_pid[i]:
+                self._send_publish(self._if_topic[i], self._if_msg[i], self._if_retain[i], 1, self._if_pid[i], True)
+
+    # Send a SUBSCRIBE packet for topic, or for a list of (topic, qos) pairs.
+    # Returns its packet id.
+    def _send_subscribe(self, topic, qos):
+        pid = self._next_pid()
+        v5 = self.version == 5
+        subs = topic if isinstance(topic, list) else ((topic, qos),)
+        sz = 2 + v5
+        for t, q in subs:
+            sz += (len(t.wire) if isinstance(t, Topic) else 2 + len(t)) + 1
+        assert sz + 5 <= len(self._tx), "SUBSCRIBE does not fit in tx buffer"
+        i = self._put_header(0x82, sz)
+        struct.pack_into("!H", self._tx, i, pid)
+        i += 2
+        if v5:
+            self._tx[i] = 0     # No properties
+            i += 1
+        for t, q in subs:
+            i = self._put_topic(i, t)
+            self._tx[i] = q
+            i += 1
+        self._write(self._tx, i)
+        self._rtt_start(pid)
+        return pid
+
+    # Subscribe and wait for the SUBACK, for at most timeout_ms if given
+    # (OSError ETIMEDOUT if it doesn't come). topic can be a list of
+    # (topic, qos) pairs, all sent in one SUBSCRIBE: the return codes of the
+    # SUBACK are then returned, one per topic (0x80 and up: refused), instead
+    # of raising MQTTException when the subscription is refused.
+    def subscribe(self, topic, qos=0, timeout_ms=None):
+        assert self.cb is not None or self._routes or self._wild, "Subscribe callback is not set"
+        pid = self._send_subscribe(topic, qos)
+        if not self.wait_for(lambda op: op == 0x90 and self.ack_pid == pid, timeout_ms):
+            raise OSError(110)
+        if isinstance(topic, list):
+            return self.suback_codes
+        if self.suback_rc >= 0x80:
+            raise MQTTException(self.suback_rc)
+
+    # Process incoming packets until cond is met or timeout_ms have passed
+    # (None: no limit). cond is a function called with the type of each packet
+    # processed (as returned by wait_msg()) that returns True when done, or a
+    # topic (str, bytes or Topic): done once a message on it has been handled.
+    # The socket is waited on with select.poll(), so this returns as soon as
+    # the packet arrives. Returns False on timeout.
+    def wait_for(self, cond, timeout_ms=None):
+        if not callable(cond):
+            name = cond.name if isinstance(cond, Topic) else cond
+            if isinstance(name, str):
+                name = name.encode()
+            cond = lambda op: op is not None and op & 0xF0 == 0x30 and self.rx_topic == name
+        if self._bn:
+            self._flush()
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        start = time.ticks_ms()
         while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+            if self._rs == self._re:
+                t = -1
+                if timeout_ms is not None:
+                    t = max(0, timeout_ms - time.ticks_diff(time.ticks_ms(), start))
+                if not poller.poll(t):
+                    return False
+            if cond(self.wait_msg()):
+                return True
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
+        res = self._rs < self._re or self._fill()
         self.sock.setblocking(True)
         if res is None:
             return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return None
-        op = res[0]
+        op = self._rx[self._rs]
+        sz, i = self._recv_len()
         if op & 0xF0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+            # Control packets are small, parse them out of the buffer
+            self._need(i + sz)
+            return self._control(op, i, sz)
+        # The PUBLISH headers must fit in the rx buffer
+        self._need(min(i + sz, len(self._rx)))
+        hl = self._publish_hdr_len(op, i)
+        topic = self.rx_topic = self._publish_topic(op, i)
+        sz -= hl - i
+        self._rs += hl
+        r = self._route(topic)
+        if r and r[2]:
+            off = 0
+            while 1:
+                if self._rs == self._re and off < sz:
+                    self._fill()
+                k = min(sz - off, self._re - self._rs)
+                r[0](topic, self._rxmv[self._rs : self._rs + k], off, sz)
+                self._rs += k
+                off += k
+                if off >= sz:
+                    break
+        elif r and r[1] is not None:
+            mv = self._route_buf(r[1], sz)
+            if mv:
+                self._read_into(mv, sz)
+                r[0](topic, mv[:sz])
+            else:
+                self._skip(sz)
+                self.rx_dropped += 1
+        elif not r and self.cb is None:
+            # No route and no callback, e.g. a subscription that a persistent
+            # session kept after its route was removed
+            self._skip(sz)
+            self.rx_dropped += 1
+        else:
+            if sz <= len(self._rx):
+                self._need(sz)
+                msg = bytes(self._rxmv[self._rs : self._rs + sz])
+                self._rs += sz
+            else:
+                msg = bytearray(sz)
+                self._read_into(memoryview(msg), sz)
+            self._dispatch(r, topic, msg)
+        return self._ack(op)
+
+    # Handle the control packet (anything but PUBLISH) at the start of the
+    # rx buffer. The whole packet must be in the buffer.
+    def _control(self, op, i, sz):
+        p = self._rs + i
+        self.n_rx_pkts += 1
+        if op == 0xD0:  # PINGRESP
+            assert sz == 0
+            op = None
+            if self._ping_t >= 0:
+                self._rtt_add(self.rtt_ping, time.ticks_diff(time.ticks_ms(), self._ping_t))
+                self._ping_t = -1
+        elif op == 0x40 or op == 0x90:  # PUBACK, SUBACK
+            self.ack_pid = self._rx[p] << 8 | self._rx[p + 1]
+            if op == 0x40:
+                # MQTT 5 may add a reason code
+                self.ack_rc = self._rx[p + 2] if sz > 2 else 0
+            else:
+                s = p + 2
+                if self.version == 5:
+                    n = self._varint(s)
+                    s = self._vp + n
+                self.suback_rc = self._rx[s]
+                self.suback_codes = bytes(self._rxmv[s : p + sz])
+            self._rtt_end(self.rtt_puback if op == 0x40 else self.rtt_suback, self.ack_pid)
+        self._rs += i + sz
+        if op == 0x40 and self.max_inflight:
+            self._puback(self.ack_pid)
+        return op
+
+    # Length of the PUBLISH headers (fixed header of i bytes, topic, packet
+    # id and MQTT 5 properties). The headers must be in the rx buffer.
+    def _publish_hdr_len(self, op, i):
+        p = self._rs + i
+        hl = i + 2 + (self._rx[p] << 8 | self._rx[p + 1])
+        if op & 6:
+            hl += 2
+        if self.version == 5:
+            # Properties are skipped. No aliases are accepted from the server.
+            n = self._varint(self._rs + hl)
+            hl = self._vp - self._rs + n
+        assert hl <= len(self._rx)
+        return hl
+
+    # Get the topic of the PUBLISH at the start of the rx buffer and keep
+    # its packet id in self._rx_pid. Needs all the headers to be in the buffer.
+    def _publish_topic(self, op, i):
+        self.n_rx_pkts += 1
+        self.n_rx_msgs += 1
+        p = self._rs + i
+        topic_len = self._rx[p] << 8 | self._rx[p + 1]
+        p += 2
+        topic = bytes(self._rxmv[p : p + topic_len])
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
+            p += topic_len
+            self._rx_pid = self._rx[p] << 8 | self._rx[p + 1]
+        return topic
+
+    def _dispatch(self, r, topic, msg):
+        (r[0] if r else self.cb)(topic, msg)
+
+    # Buffer for a payload of sz bytes on a route with buffer buf: buf itself,
+    # or one allocated for this message if it doesn't fit. None if that fails.
+    def _route_buf(self, buf, sz):
+        if sz <= len(buf):
+            return memoryview(buf)
+        try:
+            mv = memoryview(bytearray(sz))
+        except MemoryError:
+            return None
+        self.rx_oversize += 1
+        return mv
+
+    # Acknowledge a received PUBLISH if its QoS requires it
+    def _ack(self, op):
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
+            struct.pack_into("!H", pkt, 2, self._rx_pid)
+            self._write(pkt)
+            self.n_tx_pkts += 1
         elif op & 6 == 4:
             assert 0
         return op
@@ -249,7 +1048,317 @@ class MQTTClient:
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def process(self):
-        if (self.keepalive > 0 and (time.time() - self.last_ping) > self.keepalive):
+        if self._ping_due():
             self.ping()
         self.sock.setblocking(False)
-        return self.wait_msg()
\ No newline at end of file
+        return self.wait_msg()
+
+
+class _Batch:
+    def __init__(self, client):
+        self._c = client
+
+    def __enter__(self):
+        self._c._bdepth += 1
+        return self._c
+
+    def __exit__(self, exc_type, exc, tb):
+        c = self._c
+        c._bdepth -= 1
+        if not c._bdepth:
+            c._flush()
+        return False
+
+
+# MQTT client for asyncio applications. Packets are built and parsed the same
+# way as in MQTTClient, but the socket is non-blocking and accessed through
+# asyncio streams, so tasks only wake up when data arrives or a timer expires:
+#
+#   c = AsyncMQTTClient(client_id, server, keepalive=60, ssl=True, ssl_params=...)
+#   await c.connect()
+#   await c.subscribe(b"topic")
+#   async for topic, msg in c:
+#       ...
+#
+# A task reads and dispatches incoming packets, and another one sends PINGREQ
+# when the keepalive scheduler says so (see MQTTClient.next_deadline). Incoming messages go to their
+# route or the callback if there is one, otherwise they are queued (up to queue_len, oldest
+# dropped first) for the async iterator.
+# Packets already collect in the stream until a task drains it, so batch()
+# is not used here. The reader task owns the socket: the blocking receive
+# methods of MQTTClient (wait_msg, process, wait_for) must not be used.
+class AsyncMQTTClient(MQTTClient):
+    def __init__(self, client_id, server, queue_len=8, max_inflight=4, **kw):
+        assert asyncio is not None, "asyncio is not available"
+        super().__init__(client_id, server, max_inflight=max(1, max_inflight), **kw)
+        self._queue = []
+        self.queue_len = queue_len
+        self.dropped = 0
+        self._subacks = {}
+        self._ev = asyncio.Event()      # Set when a message, an ack or an error arrives
+        self._wlock = asyncio.Lock()    # Held from _write() to the end of _drain()
+        self._tasks = ()
+        self._r = None
+        self._w = None
+        self._err = None
+
+    # Writes are buffered in the stream and sent when the caller awaits _drain().
+    # Stream.drain() sends what is buffered and then empties the buffer, so data
+    # written by another task while it waits for the socket would be lost (and a
+    # second drain at the same time is not allowed). The reader, keepalive and
+    # application tasks all write, each holds _wlock from its writes to its drain.
+    def _write(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+        self._w.write(memoryview(buf)[:n])
+        self.n_writes += 1
+        self.n_tx_bytes += n
+        self.last_tx = time.ticks_ms()
+
+    async def _drain(self):
+        if self._err:
+            raise self._err
+        await self._w.drain()
+
+    async def _afill(self):
+        if self._rs == self._re:
+            self._rs = self._re = 0
+        elif self._re == len(self._rx):
+            self._compact()
+        n = await self._r.readinto(self._rxmv[self._re :])
+        if not n:
+            raise OSError(-1)
+        self.n_reads += 1
+        self.n_rx_bytes += n
+        self._re += n
+
+    async def _aneed(self, n):
+        assert n <= len(self._rx)
+        if self._rs + n > len(self._rx):
+            self._compact()
+        while self._re - self._rs < n:
+            await self._afill()
+
+    async def _aread_into(self, mv, n):
+        k = min(n, self._re - self._rs)
+        mv[:k] = self._rxmv[self._rs : self._rs + k]
+        self._rs += k
+        while k < n:
+            r = await self._r.readinto(mv[k:n])
+            if not r:
+                raise OSError(-1)
+            self.n_reads += 1
+            self.n_rx_bytes += r
+            k += r
+
+    async def connect(self, clean_session=True):
+        # Opening the socket and the TLS handshake are done by the modem and block
+        if not self._open():
+            return -1
+        self.sock.setblocking(False)
+        self._r = asyncio.StreamReader(self.sock)
+        self._w = asyncio.StreamWriter(self.sock, {})
+        self._err = None
+        self._write(self._tx, self._connect_pkt(clean_session))
+        try:
+            await self._drain()
+            await self._aneed(2)
+            await self._aneed(2 + self._rx[1])
+        except:
+            self.sock.close()
+            return -1
+        ret = self._connack()
+        if ret < 0:
+            self.sock.close()
+            return -1
+        async with self._wlock:
+            self._resend_inflight()
+            await self._drain()
+        self._tasks = (asyncio.create_task(self._reader()), asyncio.create_task(self._keepalive()))
+        return ret
+
+    async def disconnect(self):
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = ()
+        try:
+            async with self._wlock:
+                self._write(b"\xe0\0")
+                self.n_tx_pkts += 1
+                await self._drain()
+        except:
+            pass
+        self.sock.close()
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        pid = 0
+        if qos == 1:
+            while self.pending() == self.max_inflight:
+                await self._wait()
+            pid = self._next_pid()
+            i = 0
+            while self._if_pid[i]:
+                i += 1
+            self._if_pid[i] = pid
+            self._if_topic[i] = topic
+            self._if_msg[i] = msg
+            self._if_retain[i] = retain
+        elif qos == 2:
+            assert 0
+        async with self._wlock:
+            self._send_publish(topic, msg, retain, qos, pid)
+            await self._drain()
+        while self.is_pending(pid):
+            await self._wait()
+
+    async def subscribe(self, topic, qos=0):
+        async with self._wlock:
+            pid = self._send_subscribe(topic, qos)
+            await self._drain()
+        while pid not in self._subacks:
+            await self._wait()
+        codes = self._subacks.pop(pid)
+        if isinstance(topic, list):
+            return codes
+        if codes[0] >= 0x80:
+            raise MQTTException(codes[0])
+
+    async def wait_acks(self):
+        while self.pending():
+            await self._wait()
+
+    # QoS 0 only: waiting for a PUBACK that is not in the in-flight window
+    # would need wait_msg()
+    async def publish_stream(self, topic, length, source, retain=False, qos=0):
+        if qos:
+            raise MQTTException("publish_stream() is QoS 0 only in AsyncMQTTClient")
+        async with self._wlock:
+            MQTTClient.publish_stream(self, topic, length, source, retain)
+            await self._drain()
+
+    def wait_msg(self):
+        raise MQTTException("Messages are received by the reader task")
+
+    def process(self):
+        raise MQTTException("Messages are received by the reader task")
+
+    def wait_for(self, cond, timeout_ms=None):
+        raise MQTTException("Messages are received by the reader task")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            await self._wait()
+        return self._queue.pop(0)
+
+    async def _wait(self):
+        if self._err:
+            raise self._err
+        self._ev.clear()
+        await self._ev.wait()
+        if self._err:
+            raise self._err
+
+    def _dispatch(self, r, topic, msg):
+        if r:
+            r[0](topic, msg)
+        elif self.cb:
+            self.cb(topic, msg)
+        else:
+            if len(self._queue) >= self.queue_len:
+                self._queue.pop(0)
+                self.dropped += 1
+            self._queue.append((topic, msg))
+        self._ev.set()
+
+    async def _reader(self):
+        try:
+            while True:
+                await self._aneed(2)
+                op = self._rx[self._rs]
+                sz = 0
+                sh = 0
+                i = 1
+                while 1:
+                    await self._aneed(i + 1)
+                    b = self._rx[self._rs + i]
+                    i += 1
+                    sz |= (b & 0x7F) << sh
+                    if not b & 0x80:
+                        break
+                    sh += 7
+                if op & 0xF0 != 0x30:
+                    await self._aneed(i + sz)
+                    if self._control(op, i, sz) == 0x90:
+                        self._subacks[self.ack_pid] = self.suback_codes
+                    self._ev.set()
+                    continue
+                await self._aneed(min(i + sz, len(self._rx)))
+                hl = self._publish_hdr_len(op, i)
+                topic = self._publish_topic(op, i)
+                sz -= hl - i
+                self._rs += hl
+                r = self._route(topic)
+                if r and r[2]:
+                    off = 0
+                    while 1:
+                        if self._rs == self._re and off < sz:
+                            await self._afill()
+                        k = min(sz - off, self._re - self._rs)
+                        r[0](topic, self._rxmv[self._rs : self._rs + k], off, sz)
+                        self._rs += k
+                        off += k
+                        if off >= sz:
+                            break
+                elif r and r[1] is not None:
+                    mv = self._route_buf(r[1], sz)
+                    if mv:
+                        await self._aread_into(mv, sz)
+                        r[0](topic, mv[:sz])
+                    else:
+                        while sz:
+                            if self._rs == self._re:
+                                await self._afill()
+                            k = min(sz, self._re - self._rs)
+                            self._rs += k
+                            sz -= k
+                        self.rx_dropped += 1
+                else:
+                    if sz <= len(self._rx):
+                        await self._aneed(sz)
+                        msg = bytes(self._rxmv[self._rs : self._rs + sz])
+                        self._rs += sz
+                    else:
+                        msg = bytearray(sz)
+                        await self._aread_into(memoryview(msg), sz)
+                    self._dispatch(r, topic, msg)
+                if op & 6:
+                    async with self._wlock:
+                        self._ack(op)
+                        await self._drain()
+        except Exception as e:
+            # Wake up everyone waiting, they get the error. Nothing is left to
+            # answer the pings, so stop the keepalive task too.
+            self._err = e if isinstance(e, OSError) else OSError(-1)
+            self._ev.set()
+            for t in self._tasks[1:]:
+                t.cancel()
+
+    async def _keepalive(self):
+        if not self.keepalive:
+            return
+        while True:
+            if self._ping_due():
+                async with self._wlock:
+                    self.ping()
+                    await self._drain()
+                continue
+            now = time.ticks_ms()
+            wait = time.ticks_diff(self.next_deadline(), now)
+            # Past half the keepalive a ping may go out early if the radio
+            # comes up, so look again every second
+            half = time.ticks_diff(self.last_tx, now) + self.keepalive * 500
+            wait = min(wait, half if half > 0 else 1000)
+            await asyncio.sleep(max(wait, 10) / 1000)